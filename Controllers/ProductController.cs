@@ -1209,14 +1209,6 @@ namespace Bloomie.Controllers
 
             try
             {
-                var tempDir = Path.GetTempPath();
-                var tempFileName = $"{Guid.NewGuid():N}.jpg";
-                var tempPath = Path.Combine(tempDir, tempFileName);
-                using (var stream = new FileStream(tempPath, FileMode.Create))
-                {
-                    await imageFile.CopyToAsync(stream);
-                }
-
                 var scriptPath = Path.Combine(Directory.GetCurrentDirectory(), "Scripts", "analyze_image.py");
                 if (!System.IO.File.Exists(scriptPath))
                 {
@@ -1227,7 +1219,8 @@ namespace Bloomie.Controllers
                 var processInfo = new ProcessStartInfo
                 {
                     FileName = pythonPath,
-                    Arguments = $"\"{scriptPath}\" \"{tempPath}\"",
+                    Arguments = $"\"{scriptPath}\" -",
+                    RedirectStandardInput = true,
                     RedirectStandardOutput = true,
                     RedirectStandardError = true,
                     UseShellExecute = false,
@@ -1240,16 +1233,16 @@ namespace Bloomie.Controllers
                 string error;
                 using (var process = Process.Start(processInfo))
                 {
+                    // Gửi ảnh qua stdin để script giải mã trực tiếp trong bộ nhớ
+                    using (var stdin = process.StandardInput.BaseStream)
+                    {
+                        await imageFile.CopyToAsync(stdin);
+                    }
                     result = process.StandardOutput.ReadToEnd();
                     error = process.StandardError.ReadToEnd();
                     process.WaitForExit();
                 }
 
-                if (System.IO.File.Exists(tempPath))
-                {
-                    System.IO.File.Delete(tempPath);
-                }
-
                 if (!string.IsNullOrEmpty(error))
                 {
                     return Json(new { success = false, message = "Lỗi khi phân tích ảnh: " + error });
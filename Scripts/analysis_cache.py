@@ -0,0 +1,144 @@
+﻿import argparse
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Cache kết quả phân tích theo nội dung ảnh: khóa = SHA-256 của bytes ảnh + phiên bản
+# pipeline/mô hình, lưu trong SQLite, giới hạn số mục và loại bỏ mục ít dùng nhất (LRU).
+# Đặt BLOOMIE_CACHE_PATH để đổi vị trí file, hoặc BLOOMIE_CACHE_PATH=off để tắt cache.
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'analysis_cache.sqlite')
+DEFAULT_MAX_ENTRIES = int(os.environ.get('BLOOMIE_CACHE_MAX_ENTRIES', 50000))
+# Giảm số lần ghi khi đọc cache (nhiều tiến trình dùng chung một file): thời điểm truy cập
+# chỉ được cập nhật khi đã cũ hơn TOUCH_INTERVAL giây, bộ đếm hit/miss được gom trong bộ nhớ
+# và ghi xuống sau mỗi STATS_FLUSH_EVERY lần hoặc khi tiến trình kết thúc
+TOUCH_INTERVAL = 300
+STATS_FLUSH_EVERY = 100
+
+def content_key(data, version):
+    return f"{hashlib.sha256(data).hexdigest()}:{version}"
+
+class ResultCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pending_stats = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                           'key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_access ON results(last_access)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        atexit.register(self.flush_stats)
+
+    def _count(self, name):
+        self._pending_stats[name] += 1
+        if sum(self._pending_stats.values()) >= STATS_FLUSH_EVERY:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        for name, value in self._pending_stats.items():
+            if value:
+                self._conn.execute('INSERT INTO stats(name, value) VALUES (?, ?) '
+                                   'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, value))
+        self._pending_stats = {'hits': 0, 'misses': 0}
+
+    def flush_stats(self):
+        with self._lock:
+            try:
+                self._flush_stats()
+            except sqlite3.Error:
+                pass
+
+    # Lỗi SQLite (ví dụ "database is locked" khi quá thời gian chờ) không được làm hỏng
+    # request: get coi như không có trong cache, put bỏ qua
+    def get(self, key):
+        with self._lock:
+            try:
+                row = self._conn.execute('SELECT value, last_access FROM results WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    self._count('misses')
+                    return None
+                self.hits += 1
+                now = time.time()
+                if now - row[1] > TOUCH_INTERVAL:
+                    self._conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (now, key))
+                self._count('hits')
+                return json.loads(row[0])
+            except sqlite3.Error:
+                return None
+
+    def put(self, key, value):
+        with self._lock:
+            try:
+                self._conn.execute('INSERT OR REPLACE INTO results(key, value, last_access) VALUES (?, ?, ?)',
+                                   (key, json.dumps(value, ensure_ascii=False), time.time()))
+                count = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                if count > self.max_entries:
+                    self._conn.execute('DELETE FROM results WHERE key IN '
+                                       '(SELECT key FROM results ORDER BY last_access LIMIT ?)',
+                                       (count - self.max_entries,))
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM results')
+            self._conn.execute('DELETE FROM stats')
+            self._pending_stats = {'hits': 0, 'misses': 0}
+
+    def stats(self):
+        with self._lock:
+            self._flush_stats()
+            totals = dict(self._conn.execute('SELECT name, value FROM stats').fetchall())
+            entries = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'hits': totals.get('hits', 0),
+            'misses': totals.get('misses', 0),
+            'process_hits': self.hits,
+            'process_misses': self.misses
+        }
+
+_caches = {}
+
+def get_cache():
+    # Mỗi tiến trình dùng chung một kết nối; trả về None nếu cache bị tắt
+    path = os.environ.get('BLOOMIE_CACHE_PATH', DEFAULT_CACHE_PATH)
+    if path.lower() in ('', '0', 'off', 'none'):
+        return None
+    if path not in _caches:
+        try:
+            _caches[path] = ResultCache(path)
+        except (OSError, sqlite3.Error):
+            # Không tạo được thư mục hoặc không mở được cache thì vẫn phân tích bình thường
+            _caches[path] = None
+    return _caches[path]
+
+def main():
+    sys.stdout.reconfigure(encoding='utf-8')
+    parser = argparse.ArgumentParser(description='Quản lý cache kết quả phân tích ảnh')
+    parser.add_argument('command', choices=['stats', 'clear'])
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if cache is None:
+        print(json.dumps({'success': False, 'message': 'Cache đang bị tắt'}, ensure_ascii=False))
+        return
+    if args.command == 'clear':
+        cache.clear()
+    print(json.dumps(cache.stats(), ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
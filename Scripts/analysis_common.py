@@ -0,0 +1,173 @@
+﻿# Các hằng số và bước kiểm tra đầu vào dùng chung cho lớp CLI nhẹ (analyze_image.py,
+# inference.py) và các engine nặng (image_engine.py, flower_model.py). Module này chỉ
+# dùng thư viện chuẩn để dữ liệu sai bị từ chối trước khi import cv2/sklearn/torch.
+import csv
+import json
+import os
+import struct
+from contextlib import contextmanager
+
+# Thư mục gốc của web (ảnh sản phẩm, data/*.csv); đường dẫn ảnh trong CSV tính từ đây
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "wwwroot"))
+
+ALLOWED_MIME_TYPES = ['image/jpeg', 'image/png', 'image/webp']
+
+# Cạnh dài tối đa của ảnh làm việc: ảnh được giải mã thu nhỏ (JPEG) hoặc resize ngay sau khi
+# giải mã về kích thước này trước mọi bước xử lý khác. 0 nghĩa là giữ nguyên độ phân giải.
+WORKING_SIZE = int(os.environ.get('BLOOMIE_WORKING_SIZE', '512'))
+# Giới hạn số pixel được giải mã để chặn ảnh quá lớn trước khi cấp phát bộ nhớ
+MAX_IMAGE_PIXELS = int(os.environ.get('BLOOMIE_MAX_IMAGE_PIXELS', str(40 * 1000 * 1000)))
+# JPEG có thể giải mã trực tiếp ở 1/2, 1/4, 1/8 kích thước (cv2.IMREAD_REDUCED_COLOR_*)
+JPEG_REDUCTION_FACTORS = [1, 2, 4, 8]
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Nhãn FlowerModel dự đoán và đường dẫn mô hình, dùng chung cho inference.py (CLI) và flower_model.py (engine)
+COLORS = ['đỏ', 'đỏ đậm', 'đỏ tươi', 'đỏ cherry', 'đỏ rượu', 'đỏ hồng', 'h hồng', 'hồng nhạt', 'hồng đậm', 'hồng phấn',
+          'hồng đào', 'hồng san hô', 'hồng cẩm chướng', 'hồng dâu', 'hồng phai', 'hồng sen', 'trắng', 'trắng kem', 'kem',
+          'trắng ngọc trai', 'trắng sữa', 'vàng', 'vàng nhạt', 'vàng đậm', 'vàng cam', 'vàng cúc', 'vàng mù tạt',
+          'vàng ánh kim', 'vàng đồng tiền', 'cam', 'cam cháy', 'cam đào', 'cam san hô', 'cam đất', 'cam rực', 'tím',
+          'tím nhạt', 'tím violet', 'tím đậm', 'tím oải hương', 'tím lan', 'tím mộng mơ', 'tím hoàng gia', 'tím huệ',
+          'xanh dương', 'xanh dương nhạt', 'xanh ngọc', 'xanh biển', 'xanh cobalt', 'xanh sapphire', 'xanh cẩm tú cầu',
+          'xanh bạc hà', 'xanh lam', 'xanh lá', 'xanh lá nhạt', 'xanh olive', 'xanh rêu', 'xanh pastel', 'xanh đậm',
+          'xanh lá mạ', 'nâu', 'nâu nhạt', 'nâu socola', 'nâu cà phê', 'nâu đất', 'xám', 'xám nhạt', 'đen']
+PRESENTATIONS = ['Bó hoa', 'Hoa bó cổ điển', 'Giỏ hoa', 'Giỏ hoa hiện đại', 'Hộp hoa', 'Hộp hoa nghệ thuật',
+                 'Lẵng hoa', 'Lẵng hoa mini', 'Bình hoa', 'Hoa để bàn']
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "Models", "best_model.pth")
+# Artifact TorchScript lượng tử hóa cho CPU, tạo bởi export_model.py
+ARTIFACT_PATH = os.path.join(os.path.dirname(__file__), "..", "Models", "best_model_cpu.pt")
+
+COLOR_MODES = ['accurate', 'fast']
+DEFAULT_COLOR_MODE = 'accurate'
+
+def sniff_mime_type(data):
+    # Nhận dạng định dạng ảnh qua magic bytes ở đầu file
+    header = bytes(data[:12])
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def _jpeg_dimensions(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if marker in _JPEG_SOF_MARKERS and offset + 9 <= len(data):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+def _webp_dimensions(data):
+    chunk = bytes(data[12:16])
+    if chunk == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25:
+        b0, b1, b2, b3 = data[21:25]
+        return 1 + (b0 | (b1 & 0x3F) << 8), 1 + (b1 >> 6 | b2 << 2 | (b3 & 0x0F) << 10)
+    if chunk == b'VP8X' and len(data) >= 30:
+        return 1 + int.from_bytes(data[24:27], 'little'), 1 + int.from_bytes(data[27:30], 'little')
+    return None
+
+def image_dimensions(data):
+    # Đọc (rộng, cao) từ header của ảnh mà không cần giải mã; None nếu không đọc được
+    mime = sniff_mime_type(data)
+    if mime == 'image/jpeg':
+        return _jpeg_dimensions(data)
+    if mime == 'image/png' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if mime == 'image/webp':
+        return _webp_dimensions(data)
+    return None
+
+def reduction_factor(dimensions, working_size=WORKING_SIZE, max_pixels=MAX_IMAGE_PIXELS):
+    # Hệ số thu nhỏ lớn nhất mà cạnh dài vẫn không nhỏ hơn working_size, và đủ lớn để số
+    # pixel sau giải mã không vượt max_pixels
+    width, height = dimensions
+    factor = 1
+    for candidate in JPEG_REDUCTION_FACTORS:
+        fits_working_size = working_size and max(width, height) // candidate >= working_size
+        over_budget = width * height // (factor * factor) > max_pixels
+        if fits_working_size or over_budget:
+            factor = candidate
+    return factor
+
+def check_decode_budget(data, source=None, max_pixels=MAX_IMAGE_PIXELS):
+    # Từ chối ảnh mà ngay cả khi giải mã thu nhỏ vẫn vượt giới hạn pixel và trả về kích thước.
+    # Ảnh không đọc được kích thước từ header (file cắt cụt, header giả) cũng bị từ chối vì
+    # không thể biết trước bộ nhớ cần để giải mã
+    dimensions = image_dimensions(data)
+    if dimensions is None:
+        raise ValueError("Không đọc được kích thước ảnh" + (f": {source}" if source else ""))
+    width, height = dimensions
+    smallest = JPEG_REDUCTION_FACTORS[-1] if sniff_mime_type(data) == 'image/jpeg' else 1
+    if width * height // (smallest * smallest) > max_pixels:
+        raise ValueError(f"Ảnh quá lớn ({width}x{height}), tối đa {max_pixels / 1e6:g} megapixel"
+                         + (f": {source}" if source else ""))
+    return dimensions
+
+def validate_image_bytes(data, source=None):
+    # source chỉ dùng cho thông báo lỗi khi bytes được đọc từ file
+    if sniff_mime_type(data) not in ALLOWED_MIME_TYPES:
+        raise ValueError(f"File không phải hình ảnh hợp lệ: {source}" if source else "Dữ liệu tải lên không phải hình ảnh hợp lệ")
+    return data
+
+def validate_color_mode(mode):
+    if mode not in COLOR_MODES:
+        raise ValueError(f"Chế độ phân tích không hợp lệ: {mode}")
+    return mode
+
+@contextmanager
+def atomic_write(path, mode='w', encoding=None):
+    # Ghi vào file tạm rồi đổi tên: bên đọc (tiến trình khác, hoặc lần chạy sau khi bị ngắt giữa
+    # chừng) chỉ thấy file cũ hoặc file mới hoàn chỉnh, không bao giờ thấy file dở dang
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_json(path, payload, **kwargs):
+    with atomic_write(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, **kwargs)
+
+def read_manifest(manifest_path):
+    # Danh sách ảnh sản phẩm dùng chung cho catalogue_tags.py và product_index.py: CSV gồm hai
+    # cột product_id, image_path (đường dẫn tương đối với wwwroot, ví dụ /images/abc.jpg)
+    rows = []
+    with open(manifest_path, encoding='utf-8-sig', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip().isdigit():
+                continue  # bỏ qua dòng tiêu đề hoặc dòng trống
+            rows.append((int(row[0]), row[1].strip()))
+    return rows
+
+def read_image_bytes(image):
+    # image: đường dẫn file hoặc bytes của ảnh
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    try:
+        with open(image, 'rb') as f:
+            return f.read()
+    except OSError:
+        raise ValueError(f"Không thể đọc ảnh tại: {image}")
@@ -0,0 +1,139 @@
+﻿import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+import uuid
+from contextlib import contextmanager
+
+# Log có cấu trúc cho các script phân tích ảnh: mỗi request ghi một bản ghi JSON có
+# request_id và thời gian từng bước. Ghi log qua hàng đợi (luồng nền ghi file) nên
+# không chặn request, file được xoay vòng theo kích thước.
+# Đặt BLOOMIE_ANALYSIS_LOG để đổi đường dẫn file log.
+DEFAULT_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'logs', 'analysis_log.jsonl')
+MAX_LOG_BYTES = int(os.environ.get('BLOOMIE_ANALYSIS_LOG_MAX_BYTES', 5 * 1024 * 1024))
+LOG_BACKUP_COUNT = 5
+# Sau một lần xoay vòng thất bại (file đang được tiến trình khác mở trên Windows) thì chờ
+# chừng này giây mới thử lại, thay vì thử lại ở mỗi bản ghi
+ROLLOVER_RETRY_SECONDS = 60
+
+_request_id = contextvars.ContextVar('analysis_request_id', default=None)
+_timings = contextvars.ContextVar('analysis_timings', default=None)
+_logger = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'event': record.getMessage(),
+            'pid': record.process
+        }
+        payload.update(getattr(record, 'fields', {}))
+        return json.dumps(payload, ensure_ascii=False)
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Nhiều tiến trình (CLI, worker của pool) cùng ghi một file log:
+    # - tiến trình khác đã xoay vòng file thì mở lại file mới thay vì ghi tiếp vào file cũ
+    # - xoay vòng thất bại thì bỏ qua và ghi tiếp, thử lại sau ROLLOVER_RETRY_SECONDS
+    # - lỗi ghi log không bao giờ được in ra stderr (controller coi stderr là phân tích thất bại)
+    _stream_id = None
+    _retry_rollover_at = 0.0
+
+    def _open(self):
+        stream = super()._open()
+        stat = os.fstat(stream.fileno())
+        self._stream_id = (stat.st_dev, stat.st_ino)
+        return stream
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            stat = os.stat(self.baseFilename)
+            rotated = (stat.st_dev, stat.st_ino) != self._stream_id
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = None
+
+    def shouldRollover(self, record):
+        self._reopen_if_rotated()
+        if time.time() < self._retry_rollover_at:
+            return False
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        try:
+            super().doRollover()
+        except OSError:
+            self._retry_rollover_at = time.time() + ROLLOVER_RETRY_SECONDS
+
+    def handleError(self, record):
+        pass
+
+def get_logger():
+    global _logger
+    if _logger is not None:
+        return _logger
+
+    logger = logging.getLogger('bloomie.analysis')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    try:
+        log_path = os.path.abspath(os.environ.get('BLOOMIE_ANALYSIS_LOG', DEFAULT_LOG_PATH))
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        file_handler = SharedRotatingFileHandler(
+            log_path, maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+        file_handler.setFormatter(JsonFormatter())
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    except OSError:
+        # Không ghi được log thì bỏ qua, không làm hỏng kết quả phân tích
+        logger.addHandler(logging.NullHandler())
+
+    _logger = logger
+    return logger
+
+@contextmanager
+def request_context(request_id=None):
+    # Gom thời gian các bước của một request; trả về dict timings (ms). Lồng trong một
+    # request_context khác (ví dụ benchmark bọc analyze) thì dùng chung dict timings và request_id
+    outer = _timings.get()
+    timings = outer if outer is not None else {}
+    id_token = _request_id.set(request_id or _request_id.get() or uuid.uuid4().hex)
+    timings_token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(timings_token)
+        _request_id.reset(id_token)
+
+def current_request_id():
+    return _request_id.get()
+
+@contextmanager
+def stage(name):
+    timings = _timings.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = round(timings.get(name, 0.0) + (time.perf_counter() - started) * 1000, 3)
+
+def log_event(event, level=logging.INFO, **fields):
+    timings = _timings.get()
+    record_fields = {'request_id': _request_id.get()}
+    if timings:
+        record_fields['timings_ms'] = dict(timings)
+    record_fields.update(fields)
+    get_logger().log(level, event, extra={'fields': record_fields})
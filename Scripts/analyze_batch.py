@@ -0,0 +1,119 @@
+﻿import argparse
+import glob
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from analysis_common import COLOR_MODES, DEFAULT_COLOR_MODE, WORKING_SIZE
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Phân tích hàng loạt ảnh (thư mục, glob hoặc file danh sách) bằng nhiều tiến trình,
+# mỗi ảnh ghi một dòng JSON. Khi ghi ra file, các ảnh đã phân tích thành công với cùng chế độ
+# và cùng phiên bản pipeline sẽ được bỏ qua nên có thể chạy lại để tiếp tục sau khi bị ngắt;
+# ảnh lỗi hoặc có kết quả cũ được phân tích lại và ghi thêm một dòng mới (dòng sau cùng của
+# mỗi ảnh là kết quả mới nhất).
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+def collect_images(source):
+    if os.path.isdir(source):
+        paths = []
+        for dirpath, _, filenames in os.walk(source):
+            paths.extend(os.path.join(dirpath, f) for f in filenames if f.lower().endswith(IMAGE_EXTENSIONS))
+        return sorted(paths)
+
+    if os.path.isfile(source):
+        # File danh sách: mỗi dòng một đường dẫn (CSV thì lấy cột đầu tiên),
+        # đường dẫn tương đối tính từ thư mục chứa file danh sách
+        base_dir = os.path.dirname(os.path.abspath(source))
+        paths = []
+        with open(source, encoding='utf-8-sig') as f:
+            for line in f:
+                path = line.split(',')[0].strip().strip('"')
+                if not path.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                paths.append(path if os.path.isabs(path) else os.path.join(base_dir, path))
+        return paths
+
+    return sorted(p for p in glob.glob(source, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+
+def pipeline_version():
+    import analyze_image
+    return f"{analyze_image.PIPELINE_VERSION}-{WORKING_SIZE}"
+
+def load_done(output_path, mode, pipeline):
+    # Trả về (ảnh đã thành công, ảnh đã lỗi) của lần chạy hiện tại; kết quả của chế độ hoặc
+    # phiên bản pipeline khác (ví dụ sau khi đổi bảng màu) không được tính là xong
+    done, failed = set(), set()
+    if not output_path or not os.path.exists(output_path):
+        return done, failed
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if result.get('mode') != mode or result.get('pipeline') != pipeline:
+                    continue
+                (done if result.get('success') else failed).add(result['image'])
+            except (ValueError, KeyError, AttributeError):
+                # Dòng cuối có thể bị ghi dở nếu lần chạy trước bị ngắt
+                continue
+    return done, failed - done
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def _init_worker():
+    import image_engine  # noqa: F401 - nạp sẵn các thư viện nặng
+
+def _analyze(job):
+    import analyze_image
+    image_path, mode, pipeline = job
+    try:
+        result = analyze_image.analyze(image_path, mode=mode)
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    return {'image': image_path, 'mode': mode, 'pipeline': pipeline, **result}
+
+def run_batch(source, output_path=None, workers=None, mode=DEFAULT_COLOR_MODE):
+    images = collect_images(source)
+    pipeline = pipeline_version()
+    done, previously_failed = load_done(output_path, mode, pipeline)
+    pending = [p for p in images if p not in done]
+    workers = workers or os.cpu_count() or 1
+
+    out = open(output_path, 'a', encoding='utf-8') if output_path else sys.stdout
+    if output_path and out.tell() > 0 and not _ends_with_newline(output_path):
+        out.write('\n')
+    processed = 0
+    failed = 0
+    try:
+        with Pool(processes=workers, initializer=_init_worker) as pool:
+            for result in pool.imap_unordered(_analyze, [(p, mode, pipeline) for p in pending], chunksize=4):
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                out.flush()
+                processed += 1
+                if not result.get('success'):
+                    failed += 1
+    finally:
+        if output_path:
+            out.close()
+
+    return {'total': len(images), 'skipped': len(images) - len(pending), 'processed': processed,
+            'retried': sum(1 for p in pending if p in previously_failed), 'failed': failed}
+
+def main():
+    parser = argparse.ArgumentParser(description='Phân tích màu sắc và kiểu trình bày cho nhiều ảnh cùng lúc')
+    parser.add_argument('source', help='Thư mục ảnh, mẫu glob hoặc file danh sách đường dẫn ảnh')
+    parser.add_argument('--output', help='File JSON lines để ghi kết quả (cho phép chạy tiếp)')
+    parser.add_argument('--workers', type=int, default=None, help='Số tiến trình (mặc định: số nhân CPU)')
+    parser.add_argument('--mode', default=DEFAULT_COLOR_MODE, choices=COLOR_MODES)
+    args = parser.parse_args()
+
+    summary = run_batch(args.source, args.output, args.workers, args.mode)
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
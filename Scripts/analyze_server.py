@@ -0,0 +1,160 @@
+﻿import argparse
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Server chạy lâu dài: mỗi worker import image_engine (cv2, sklearn, skimage) một lần
+# rồi giữ nguyên, thay vì khởi động lại Python cho mỗi ảnh tải lên.
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5055
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# Thời gian tối đa một request chờ kết quả, để worker bị treo không giữ luồng HTTP mãi mãi
+REQUEST_TIMEOUT = float(os.environ.get('BLOOMIE_ANALYZE_TIMEOUT', 60))
+
+def _init_worker():
+    import image_engine  # noqa: F401 - nạp sẵn các thư viện nặng
+
+def _analyze(image, mode=None):
+    import analyze_image
+    try:
+        return analyze_image.analyze(image, mode=mode or analyze_image.DEFAULT_COLOR_MODE)
+    except Exception as e:
+        return {'success': False, 'message': str(e)}
+
+class WorkerPool:
+    # Bọc ProcessPoolExecutor: khi một worker chết đột ngột (hết bộ nhớ, cv2 crash) pool chuyển
+    # sang BrokenProcessPool và từ chối mọi việc sau đó, nên tạo lại pool mới thay vì hỏng vĩnh viễn
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = self._create()
+
+    def _create(self):
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        # Khởi động trước tất cả worker để request đầu tiên không phải chờ import
+        for f in [pool.submit(_init_worker) for _ in range(self.workers)]:
+            f.result()
+        return pool
+
+    def _restart(self, broken, kill=False):
+        with self._lock:
+            if self._pool is broken:
+                if kill:
+                    # future.cancel() không dừng được việc đã bắt đầu chạy: kill các tiến trình con
+                    # (như job_queue._WarmWorker.run) để worker bị treo không chiếm slot mãi mãi
+                    broken.killed = True
+                    for process in list(broken._processes.values()):
+                        process.kill()
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create()
+            return self._pool
+
+    def run(self, fn, *args, timeout=REQUEST_TIMEOUT, retry=True):
+        pool = self._pool
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            pool = self._restart(pool)
+            future = pool.submit(fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self._restart(pool)
+            if retry and getattr(pool, 'killed', False):
+                # Request khác bị hủy theo khi pool bị kill vì quá thời gian: chạy lại một lần trên pool mới
+                return self.run(fn, *args, timeout=timeout, retry=False)
+            return {'success': False, 'message': 'Tiến trình phân tích bị dừng đột ngột, vui lòng thử lại'}
+        except FutureTimeoutError:
+            self._restart(pool, kill=True)
+            return {'success': False, 'timeout': True, 'message': f'Quá thời gian phân tích ({timeout:g} giây)'}
+
+    def shutdown(self):
+        self._pool.shutdown(cancel_futures=True)
+
+class AnalyzeHandler(BaseHTTPRequestHandler):
+    server_version = 'BloomieAnalyze/1.0'
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'success': True, 'workers': self.server.workers})
+        else:
+            self._send_json(404, {'success': False, 'message': 'Không tìm thấy đường dẫn'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/analyze':
+            self._send_json(404, {'success': False, 'message': 'Không tìm thấy đường dẫn'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send_json(400, {'success': False, 'message': 'Vui lòng cung cấp ảnh hoặc đường dẫn ảnh'})
+            return
+        if length > MAX_UPLOAD_BYTES:
+            self._send_json(413, {'success': False, 'message': 'Ảnh tải lên quá lớn'})
+            return
+
+        data = self.rfile.read(length)
+        content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        # Chế độ trích màu chọn theo từng request: ?mode=fast hoặc "mode" trong JSON
+        mode = parse_qs(url.query).get('mode', [None])[0]
+        try:
+            # JSON {"path": "..."} để phân tích file có sẵn, còn lại coi body là bytes của ảnh
+            if content_type == 'application/json':
+                request = json.loads(data.decode('utf-8'))
+                image_path = request.get('path')
+                if not image_path:
+                    raise ValueError("Vui lòng cung cấp đường dẫn ảnh")
+                result = self.server.pool.run(_analyze, image_path, request.get('mode', mode))
+            else:
+                # Bytes của ảnh được giải mã trực tiếp trong bộ nhớ, không ghi file tạm
+                result = self.server.pool.run(_analyze, data, mode)
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+
+        self._send_json(504 if result.get('timeout') else 200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None):
+    workers = workers or os.cpu_count() or 1
+    pool = WorkerPool(workers)
+    httpd = ThreadingHTTPServer((host, port), AnalyzeHandler)
+    httpd.pool = pool
+    httpd.workers = workers
+    print(json.dumps({'success': True, 'message': f'Đang lắng nghe tại http://{host}:{port}', 'workers': workers},
+                     ensure_ascii=False), flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        pool.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Server phân tích ảnh hoa (giữ sẵn các thư viện đã nạp)')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help='Số tiến trình worker (mặc định: số nhân CPU)')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+if __name__ == '__main__':
+    main()
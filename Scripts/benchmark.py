@@ -0,0 +1,252 @@
+﻿import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+from analysis_common import COLOR_MODES, ROOT_DIR
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Bộ đo hiệu năng cho analyze_image.py và inference.py. Mỗi mục tiêu chạy trong một
+# tiến trình con riêng để đo thời gian khởi động và bộ nhớ đỉnh (peak RSS) độc lập.
+# Kết quả ghi ra file JSON để so sánh giữa các lần chạy.
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(SCRIPTS_DIR, '.cache', 'bench_images')
+SYNTHETIC_SIZES = [(640, 480), (1280, 960), (4032, 3024)]
+SYNTHETIC_PER_SIZE = 4
+# Lớp CLI nhẹ và engine nặng được đo thời gian import riêng
+ENGINE_MODULES = {'analyze_image': 'image_engine', 'inference': 'flower_model'}
+
+def generate_synthetic_images(out_dir=BENCH_DIR, seed=0):
+    # Ảnh tổng hợp cố định theo seed: nền sáng với các "bông hoa" hình tròn/elip nhiều màu
+    import cv2
+    import numpy as np
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    paths = []
+    for width, height in SYNTHETIC_SIZES:
+        for i in range(SYNTHETIC_PER_SIZE):
+            path = os.path.join(out_dir, f'synthetic_{width}x{height}_{i}.jpg')
+            paths.append(path)
+            if os.path.exists(path):
+                continue
+            img = np.full((height, width, 3), rng.randint(200, 256, size=3), dtype=np.uint8)
+            for _ in range(rng.randint(5, 15)):
+                center = (int(rng.randint(width // 5, 4 * width // 5)), int(rng.randint(height // 5, 4 * height // 5)))
+                axes = (int(rng.randint(width // 30, width // 8)), int(rng.randint(height // 30, height // 8)))
+                color = tuple(int(c) for c in rng.randint(0, 256, size=3))
+                cv2.ellipse(img, center, axes, float(rng.randint(0, 180)), 0, 360, color, -1)
+            img = cv2.GaussianBlur(img, (7, 7), 0)
+            noise = rng.normal(0, 6, img.shape)
+            img = np.clip(img.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+            cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return paths
+
+def sample_images(limit):
+    # Ảnh thật lấy từ tập dữ liệu huấn luyện (nếu có trên máy)
+    paths = []
+    for csv_file in ('data/val.csv', 'data/test.csv', 'data/train.csv'):
+        csv_path = os.path.join(ROOT_DIR, csv_file)
+        if not os.path.exists(csv_path):
+            continue
+        with open(csv_path, encoding='utf-8-sig') as f:
+            for line in f.readlines()[1:]:
+                image_path = os.path.join(ROOT_DIR, line.split(',')[0].strip())
+                if line.strip() and os.path.exists(image_path) and image_path not in paths:
+                    paths.append(image_path)
+                if len(paths) >= limit:
+                    return paths
+    return paths
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': pick(50),
+        'p90': pick(90),
+        'p99': pick(99),
+        'max': ordered[-1]
+    }
+
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux trả về KB, macOS trả về byte
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        try:
+            import psutil
+            memory = psutil.Process().memory_info()
+            return getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024)
+        except ImportError:
+            return None
+
+def measure_import(module, repeats=3):
+    # Thời gian khởi động: chạy "import <module>" trong tiến trình Python mới
+    wall = []
+    importtime_us = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                              cwd=SCRIPTS_DIR, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        wall.append((time.perf_counter() - started) * 1000)
+        match = re.search(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*' + re.escape(module) + r'\s*$',
+                          proc.stderr, re.MULTILINE)
+        if match:
+            importtime_us = int(match.group(1))
+    return {
+        'wall_ms': percentiles(wall),
+        'cumulative_import_ms': importtime_us / 1000 if importtime_us is not None else None
+    }
+
+def bench_analyze(images, modes, repeats):
+    import analyze_image
+    from analysis_logging import request_context
+
+    results = {}
+    for mode in modes:
+        stages = {}
+        end_to_end = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(repeats):
+            for image_path in images:
+                with request_context() as timings:
+                    t0 = time.perf_counter()
+                    try:
+                        analyze_image.analyze(image_path, mode=mode, use_cache=False)
+                    except Exception:
+                        errors += 1
+                        continue
+                    end_to_end.append((time.perf_counter() - t0) * 1000)
+                for name, value in timings.items():
+                    stages.setdefault(name, []).append(value)
+        elapsed = time.perf_counter() - started
+        if end_to_end and not stages:
+            raise RuntimeError("Không thu được thời gian từng bước, kiểm tra request_context trong analyze_image")
+        results[mode] = {
+            'end_to_end_ms': percentiles(end_to_end),
+            'stages_ms': {name: percentiles(values) for name, values in stages.items()},
+            'images_per_sec': len(end_to_end) / elapsed if elapsed > 0 else 0.0,
+            'errors': errors
+        }
+    return results
+
+def bench_inference(images, repeats, batch_size):
+    import flower_model
+    import inference
+    import torch
+    from analysis_common import ARTIFACT_PATH, MODEL_PATH
+
+    if not os.path.exists(MODEL_PATH) and not os.path.exists(ARTIFACT_PATH):
+        return {'skipped': 'Không tìm thấy trọng số mô hình'}
+
+    started = time.perf_counter()
+    flower_model.load_model()
+    load_ms = (time.perf_counter() - started) * 1000
+
+    single = []
+    for _ in range(repeats):
+        for image_path in images:
+            t0 = time.perf_counter()
+            inference.predict(image_path, use_cache=False)
+            single.append((time.perf_counter() - t0) * 1000)
+
+    tensors = [flower_model.load_image(p) for p in images]
+    batched = []
+    started = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(repeats):
+            for i in range(0, len(tensors), batch_size):
+                t0 = time.perf_counter()
+                flower_model.predict_batch(tensors[i:i + batch_size])
+                batched.append((time.perf_counter() - t0) * 1000)
+    batch_elapsed = time.perf_counter() - started
+
+    return {
+        'model_load_ms': load_ms,
+        'artifact': flower_model.use_artifact(),
+        'single_image_ms': percentiles(single),
+        'single_images_per_sec': 1000 * len(single) / sum(single) if single else 0.0,
+        'batch_size': batch_size,
+        'batch_ms': percentiles(batched),
+        'batched_images_per_sec': len(tensors) * repeats / batch_elapsed if batch_elapsed > 0 else 0.0
+    }
+
+def run_child(target, images, args):
+    if target == 'analyze_image':
+        result = bench_analyze(images, args.modes, args.repeats)
+    else:
+        result = bench_inference(images, args.repeats, args.batch_size)
+    result['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(result, ensure_ascii=False))
+
+def run_target(target, image_list_path, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', target, '--image-list', image_list_path,
+               '--repeats', str(args.repeats), '--batch-size', str(args.batch_size), '--modes', *args.modes]
+    env = dict(os.environ, BLOOMIE_CACHE_PATH='off')
+    proc = subprocess.run(command, cwd=SCRIPTS_DIR, capture_output=True, text=True, encoding='utf-8', env=env)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        return {'error': proc.stderr.strip()[-2000:]}
+    return json.loads(lines[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Đo hiệu năng analyze_image.py và inference.py')
+    parser.add_argument('--output', default='bench_results.json', help='File JSON để ghi kết quả')
+    parser.add_argument('--targets', nargs='+', choices=['analyze_image', 'inference'], default=['analyze_image', 'inference'])
+    parser.add_argument('--modes', nargs='+', choices=COLOR_MODES, default=COLOR_MODES)
+    parser.add_argument('--samples', type=int, default=8, help='Số ảnh thật lấy từ wwwroot/data')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--child', choices=['analyze_image', 'inference'], help=argparse.SUPPRESS)
+    parser.add_argument('--image-list', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.image_list, encoding='utf-8') as f:
+            run_child(args.child, json.load(f), args)
+        return
+
+    images = generate_synthetic_images() + sample_images(args.samples)
+    image_list_path = os.path.join(BENCH_DIR, 'images.json')
+    with open(image_list_path, 'w', encoding='utf-8') as f:
+        json.dump(images, f, ensure_ascii=False)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'images': {'synthetic': len(SYNTHETIC_SIZES) * SYNTHETIC_PER_SIZE, 'samples': len(images) - len(SYNTHETIC_SIZES) * SYNTHETIC_PER_SIZE},
+        'repeats': args.repeats,
+        'targets': {}
+    }
+    for target in args.targets:
+        report['targets'][target] = {
+            'startup': measure_import(target),
+            'engine_startup': measure_import(ENGINE_MODULES[target]),
+            'run': run_target(target, image_list_path, args)
+        }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps({'success': True, 'output': os.path.abspath(args.output)}, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+﻿import argparse
+import hashlib
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from analysis_common import COLOR_MODES, DEFAULT_COLOR_MODE, ROOT_DIR, WORKING_SIZE, atomic_write_json, read_manifest
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Gắn nhãn màu/kiểu trình bày cho ảnh sản phẩm trong catalogue (chạy offline, tăng dần):
+# chỉ ảnh mới hoặc đã thay đổi (kích thước, thời điểm sửa, rồi mới đến hash nội dung) được
+# phân tích lại. Kết quả là chỉ mục ngược màu -> product_id và kiểu trình bày -> product_id,
+# để tìm kiếm theo ảnh chỉ còn là phép giao các tập thay vì duyệt toàn bộ sản phẩm.
+TAG_DIR = os.path.join(os.path.dirname(__file__), "..", "Models", "catalogue_tags")
+SOURCES = ['analyze', 'model', 'both']
+
+def pipeline_version(source, mode):
+    # Nhãn cũ không còn hợp lệ khi đổi pipeline phân tích hoặc mô hình
+    parts = [source, mode]
+    if source in ('analyze', 'both'):
+        import analyze_image
+        parts.append(f"analyze-{analyze_image.PIPELINE_VERSION}-{WORKING_SIZE}")
+    if source in ('model', 'both'):
+        import inference
+        parts.append(f"model-{inference.model_version()}")
+    return '|'.join(parts)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _init_worker():
+    import image_engine  # noqa: F401 - nạp sẵn các thư viện nặng
+
+def _tag(job):
+    image, full_path, source, mode = job
+    colors, presentation = set(), None
+    try:
+        if source in ('analyze', 'both'):
+            import analyze_image
+            result = analyze_image.analyze(full_path, mode=mode)
+            colors.update(result['colors'])
+            presentation = result['presentation']
+        if source in ('model', 'both'):
+            import inference
+            result = inference.predict(full_path)
+            if not result.get('success'):
+                raise ValueError(result.get('message'))
+            colors.update(result['colors'])
+            presentation = result['presentation']
+    except Exception as e:
+        return image, {'success': False, 'message': str(e)}
+    return image, {'success': True, 'colors': sorted(colors), 'presentation': presentation}
+
+class CatalogueTags:
+    def __init__(self, tag_dir=TAG_DIR):
+        self.tag_dir = tag_dir
+        self.state_path = os.path.join(tag_dir, 'state.json')
+        self.index_path = os.path.join(tag_dir, 'index.json')
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {'pipeline': None, 'images': {}}
+        with open(self.state_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def load_index(self):
+        with open(self.index_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def update(self, manifest_rows, root_dir=ROOT_DIR, source='analyze', mode=DEFAULT_COLOR_MODE, workers=None, full=False):
+        state = self.load_state()
+        pipeline = pipeline_version(source, mode)
+        if full or state.get('pipeline') != pipeline:
+            state = {'pipeline': pipeline, 'images': {}}
+        previous = state['images']
+        images = {}
+        pending = []
+        missing = []
+
+        # Một ảnh có thể dùng chung cho nhiều sản phẩm hoặc lặp lại trong manifest: gom theo ảnh
+        # để mỗi ảnh chỉ được phân tích một lần và gắn cho mọi sản phẩm dùng nó
+        products_by_image = {}
+        for product_id, image in manifest_rows:
+            products_by_image.setdefault(image, set()).add(product_id)
+
+        for image, product_ids in products_by_image.items():
+            product_ids = sorted(product_ids)
+            full_path = os.path.join(root_dir, image.lstrip('/\\'))
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                missing.append(image)
+                continue
+            entry = previous.get(image)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                images[image] = {**entry, 'product_ids': product_ids}
+                continue
+            content_hash = file_hash(full_path)
+            if entry and entry['sha256'] == content_hash:
+                # Chỉ thời điểm sửa thay đổi (ví dụ sao chép lại file), nhãn vẫn dùng được
+                images[image] = {**entry, 'product_ids': product_ids, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                continue
+            images[image] = {'product_ids': product_ids, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                             'sha256': content_hash, 'colors': [], 'presentation': None}
+            pending.append((image, full_path, source, mode))
+
+        failed = []
+        if pending:
+            # Mô hình PyTorch đã tự dùng nhiều luồng nên chỉ chạy song song nhiều tiến trình cho nhánh analyze
+            processes = 1 if source != 'analyze' else workers or os.cpu_count() or 1
+            with Pool(processes=processes, initializer=_init_worker if source != 'model' else None) as pool:
+                for image, result in pool.imap_unordered(_tag, pending, chunksize=4):
+                    if result['success']:
+                        images[image].update(colors=result['colors'], presentation=result['presentation'])
+                    else:
+                        # Không lưu ảnh lỗi vào trạng thái để lần chạy sau thử lại
+                        failed.append({'image': image, 'product_ids': images[image]['product_ids'],
+                                       'message': result['message']})
+                        del images[image]
+
+        state = {'pipeline': pipeline, 'images': images}
+        atomic_write_json(self.state_path, state)
+        index = self.build_index(images)
+        atomic_write_json(self.index_path, index, separators=(',', ':'))
+        return {
+            'success': True,
+            'images': len(images),
+            'tagged': len(pending) - len(failed),
+            'unchanged': len(images) - (len(pending) - len(failed)),
+            'removed': len(set(previous) - set(images) - {f['image'] for f in failed}),
+            'missing': missing,
+            'failed': failed,
+            'products': index['products']
+        }
+
+    @staticmethod
+    def build_index(images):
+        # Một sản phẩm có nhiều ảnh được gắn hợp các nhãn của mọi ảnh
+        colors, presentations, products = {}, {}, set()
+        for entry in images.values():
+            product_ids = entry['product_ids']
+            products.update(product_ids)
+            for color in entry['colors']:
+                colors.setdefault(color, set()).update(product_ids)
+            if entry['presentation']:
+                presentations.setdefault(entry['presentation'], set()).update(product_ids)
+        return {
+            'products': len(products),
+            'colors': {name: sorted(ids) for name, ids in sorted(colors.items())},
+            'presentations': {name: sorted(ids) for name, ids in sorted(presentations.items())}
+        }
+
+    def query(self, colors=None, presentations=None, any_color=False):
+        # Giao các tập product_id; nhiều màu thì mặc định sản phẩm phải có đủ tất cả (any_color: chỉ cần một)
+        index = self.load_index()
+        sets = []
+        colors = [c.strip().lower() for c in colors or [] if c.strip()]
+        if colors:
+            color_sets = [set(index['colors'].get(c, [])) for c in colors]
+            sets.append(set().union(*color_sets) if any_color else set.intersection(*color_sets))
+        presentations = [p.strip() for p in presentations or [] if p.strip()]
+        if presentations:
+            # Các kiểu trình bày khác nhau là lựa chọn thay thế nên lấy hợp
+            sets.append(set().union(*(index['presentations'].get(p, []) for p in presentations)))
+        if not sets:
+            return []
+        return sorted(set.intersection(*sets))
+
+def main():
+    parser = argparse.ArgumentParser(description='Gắn nhãn màu/kiểu trình bày cho ảnh sản phẩm và tra cứu theo nhãn')
+    parser.add_argument('--tag-dir', default=TAG_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help='Phân tích ảnh mới/đã thay đổi và ghi lại chỉ mục')
+    update_parser.add_argument('manifest', help='File CSV product_id,image_path')
+    update_parser.add_argument('--root', default=ROOT_DIR)
+    update_parser.add_argument('--source', choices=SOURCES, default='analyze',
+                               help='analyze: get_dominant_colors/classify_presentation, model: FlowerModel, both: gộp cả hai')
+    update_parser.add_argument('--mode', choices=COLOR_MODES, default=DEFAULT_COLOR_MODE)
+    update_parser.add_argument('--workers', type=int, default=None)
+    update_parser.add_argument('--full', action='store_true', help='Bỏ qua trạng thái cũ và gắn nhãn lại toàn bộ')
+
+    query_parser = subparsers.add_parser('query', help='Tìm product_id theo màu và kiểu trình bày')
+    query_parser.add_argument('--colors', default='', help='Danh sách màu, phân tách bằng dấu phẩy')
+    query_parser.add_argument('--presentations', default='', help='Danh sách kiểu trình bày, phân tách bằng dấu phẩy')
+    query_parser.add_argument('--any-color', action='store_true', help='Chỉ cần khớp một trong các màu')
+
+    args = parser.parse_args()
+    tags = CatalogueTags(args.tag_dir)
+    try:
+        if args.command == 'update':
+            result = tags.update(read_manifest(args.manifest), args.root, args.source, args.mode, args.workers, args.full)
+        else:
+            product_ids = tags.query(args.colors.split(','), args.presentations.split(','), args.any_color)
+            result = {'success': True, 'product_ids': product_ids}
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
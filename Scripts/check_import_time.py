@@ -0,0 +1,82 @@
+﻿import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Kiểm tra hồi quy thời gian khởi động: đo "python -X importtime -c 'import <module>'" cho
+# các entry point nhẹ và so với ngân sách trong import_budget.json. Đồng thời báo lỗi nếu
+# một thư viện nặng (cv2, torch, ...) bị import ngay khi khởi động. Mã thoát 1 khi vượt ngân sách.
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BUDGET_PATH = os.path.join(SCRIPTS_DIR, 'import_budget.json')
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+def measure(module):
+    # Trả về (thời gian import tích lũy của module tính bằng ms, tập các module đã được import)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SCRIPTS_DIR,
+                          capture_output=True, text=True, encoding='utf-8', errors='replace')
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"Không thể import {module}")
+    cumulative_us = None
+    imported = set()
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        name = match.group(4)
+        imported.add(name.split('.')[0])
+        # Module cấp cao nhất được in với đúng một khoảng trắng thụt lề
+        if name == module and len(match.group(3)) == 1:
+            cumulative_us = int(match.group(2))
+    if cumulative_us is None:
+        raise RuntimeError(f"Không tìm thấy thời gian import của {module}")
+    return cumulative_us / 1000, imported
+
+def check(budget_path=BUDGET_PATH, runs=None):
+    with open(budget_path, encoding='utf-8') as f:
+        budget = json.load(f)
+    runs = runs or budget.get('runs', 5)
+    forbidden = set(budget.get('forbidden', []))
+
+    report = {}
+    ok = True
+    for module, limits in budget['modules'].items():
+        timings = []
+        imported = set()
+        for _ in range(runs):
+            elapsed_ms, names = measure(module)
+            timings.append(elapsed_ms)
+            imported |= names
+        median_ms = statistics.median(timings)
+        heavy = sorted(imported & forbidden)
+        passed = median_ms <= limits['budget_ms'] and not heavy
+        ok = ok and passed
+        report[module] = {
+            'median_ms': round(median_ms, 2),
+            'budget_ms': limits['budget_ms'],
+            'measured_ms': limits.get('measured_ms'),
+            'heavy_imports': heavy,
+            'passed': passed
+        }
+    return ok, report
+
+def main():
+    parser = argparse.ArgumentParser(description='Kiểm tra ngân sách thời gian import của các script')
+    parser.add_argument('--budget', default=BUDGET_PATH)
+    parser.add_argument('--runs', type=int, default=None)
+    args = parser.parse_args()
+
+    try:
+        ok, report = check(args.budget, args.runs)
+        result = {'success': ok, 'modules': report}
+    except Exception as e:
+        ok, result = False, {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+﻿import argparse
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+import image_engine
+from analysis_common import ROOT_DIR
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# So sánh chế độ trích màu "fast" với "accurate" trên một tập ảnh đã gán nhãn
+# (cùng định dạng với wwwroot/data/*.csv: image_path, colors, presentation)
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+def run_mode(image_path, mode):
+    decoded = image_engine.load_image(image_path)
+    started = time.perf_counter()
+    colors = image_engine.get_dominant_colors(decoded, num_colors=6, mode=mode)
+    return colors, (time.perf_counter() - started) * 1000
+
+def compare(csv_file, root_dir=ROOT_DIR):
+    data = pd.read_csv(csv_file)
+    per_image = []
+    errors = []
+
+    for _, row in data.iterrows():
+        image_path = os.path.join(root_dir, row.iloc[0])
+        labels = [c.strip() for c in str(row.iloc[1]).split(',') if c.strip()]
+        try:
+            accurate, accurate_ms = run_mode(image_path, 'accurate')
+            fast, fast_ms = run_mode(image_path, 'fast')
+        except Exception as e:
+            errors.append({'image': row.iloc[0], 'message': str(e)})
+            continue
+
+        per_image.append({
+            'image': row.iloc[0],
+            'labels': labels,
+            'accurate': accurate,
+            'fast': fast,
+            'accurate_ms': accurate_ms,
+            'fast_ms': fast_ms,
+            'agreement_jaccard': jaccard(accurate, fast),
+            'accurate_label_hit': bool(set(accurate) & set(labels)),
+            'fast_label_hit': bool(set(fast) & set(labels)),
+            'accurate_label_jaccard': jaccard(accurate, labels),
+            'fast_label_jaccard': jaccard(fast, labels)
+        })
+
+    def mean(key):
+        return sum(float(r[key]) for r in per_image) / len(per_image) if per_image else 0.0
+
+    accurate_ms = mean('accurate_ms')
+    fast_ms = mean('fast_ms')
+    return {
+        'images': len(per_image),
+        'errors': errors,
+        'summary': {
+            'agreement_jaccard': mean('agreement_jaccard'),
+            'agreement_exact': sum(set(r['accurate']) == set(r['fast']) for r in per_image) / len(per_image) if per_image else 0.0,
+            'accurate_label_hit_rate': mean('accurate_label_hit'),
+            'fast_label_hit_rate': mean('fast_label_hit'),
+            'accurate_label_jaccard': mean('accurate_label_jaccard'),
+            'fast_label_jaccard': mean('fast_label_jaccard'),
+            'accurate_ms_mean': accurate_ms,
+            'fast_ms_mean': fast_ms,
+            'speedup': accurate_ms / fast_ms if fast_ms > 0 else 0.0
+        },
+        'per_image': per_image
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Báo cáo độ khớp giữa chế độ trích màu fast và accurate')
+    parser.add_argument('--csv', default=os.path.join(ROOT_DIR, 'data', 'val.csv'))
+    parser.add_argument('--root', default=ROOT_DIR, help='Thư mục gốc của đường dẫn ảnh trong CSV')
+    parser.add_argument('--output', help='Ghi báo cáo JSON ra file thay vì stdout')
+    args = parser.parse_args()
+
+    report = compare(args.csv, args.root)
+    json_str = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(json_str)
+        print(json.dumps(report['summary'], ensure_ascii=False))
+    else:
+        print(json_str)
+
+if __name__ == '__main__':
+    main()
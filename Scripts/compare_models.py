@@ -0,0 +1,104 @@
+﻿import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+import flower_model
+from analysis_common import ARTIFACT_PATH, MODEL_PATH, ROOT_DIR
+from export_model import load_fp32_model
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# So sánh artifact CPU (export_model.py) với mô hình fp32 gốc: độ trễ, kích thước,
+# độ khớp kiểu trình bày (top-1) và F1 của nhãn màu (ngưỡng 0.5) so với fp32.
+def latency_ms(model, images, warmup=3):
+    with torch.no_grad():
+        for image in images[:warmup]:
+            model(image.unsqueeze(0))
+        timings = []
+        for image in images:
+            started = time.perf_counter()
+            model(image.unsqueeze(0))
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'mean': float(np.mean(timings)),
+        'p50': float(np.percentile(timings, 50)),
+        'p95': float(np.percentile(timings, 95))
+    }
+
+def predict_all(model, images, batch_size=16):
+    color_outs, pres_outs = [], []
+    with torch.no_grad():
+        for i in range(0, len(images), batch_size):
+            color_out, pres_out = model(torch.stack(images[i:i + batch_size]))
+            color_outs.append(color_out)
+            pres_outs.append(pres_out)
+    return torch.cat(color_outs).numpy(), torch.cat(pres_outs).numpy()
+
+def compare(csv_file, artifact_path=ARTIFACT_PATH, limit=None):
+    image_paths = pd.read_csv(os.path.join(ROOT_DIR, csv_file)).iloc[:, 0].tolist()
+    if limit:
+        image_paths = image_paths[:limit]
+    images = []
+    for image_path in image_paths:
+        try:
+            images.append(flower_model.load_image(os.path.join(ROOT_DIR, image_path)))
+        except Exception:
+            continue
+    if not images:
+        raise RuntimeError("Không có ảnh hợp lệ để so sánh")
+
+    fp32 = load_fp32_model()
+    optimized = torch.jit.load(artifact_path, map_location='cpu')
+    optimized.eval()
+
+    ref_colors, ref_pres = predict_all(fp32, images)
+    opt_colors, opt_pres = predict_all(optimized, images)
+
+    ref_labels = ref_colors > 0.5
+    opt_labels = opt_colors > 0.5
+    true_positive = np.logical_and(ref_labels, opt_labels).sum()
+    precision = true_positive / opt_labels.sum() if opt_labels.sum() else 1.0
+    recall = true_positive / ref_labels.sum() if ref_labels.sum() else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+    fp32_latency = latency_ms(fp32, images)
+    optimized_latency = latency_ms(optimized, images)
+
+    return {
+        'images': len(images),
+        'fp32': {
+            'size_mb': os.path.getsize(MODEL_PATH) / (1024 * 1024),
+            'latency_ms': fp32_latency
+        },
+        'optimized': {
+            'artifact': os.path.abspath(artifact_path),
+            'size_mb': os.path.getsize(artifact_path) / (1024 * 1024),
+            'latency_ms': optimized_latency
+        },
+        'speedup': fp32_latency['mean'] / optimized_latency['mean'] if optimized_latency['mean'] > 0 else 0.0,
+        'presentation_top1_agreement': float(np.mean(ref_pres.argmax(axis=1) == opt_pres.argmax(axis=1))),
+        'color_f1_vs_fp32': float(f1),
+        'color_max_abs_diff': float(np.abs(ref_colors - opt_colors).max())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='So sánh artifact CPU lượng tử hóa với mô hình fp32')
+    parser.add_argument('--csv', default='data/val.csv', help='File CSV (tương đối với wwwroot) chứa ảnh để so sánh')
+    parser.add_argument('--artifact', default=ARTIFACT_PATH)
+    parser.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+
+    try:
+        result = compare(args.csv, args.artifact, args.limit)
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
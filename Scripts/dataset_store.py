@@ -0,0 +1,135 @@
+﻿import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+from analysis_common import atomic_write_json
+
+# Kho dữ liệu huấn luyện đã tiền xử lý: ảnh được giải mã và resize một lần vào file
+# .npy dạng memory-map (uint8, N x H x W x 3), nhãn được mã hóa sẵn thành mảng.
+# Mỗi epoch chỉ còn đọc mảng thay vì mở và giải mã lại ảnh gốc.
+DEFAULT_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'dataset')
+
+def store_path(csv_file, store_root=DEFAULT_STORE_DIR):
+    return os.path.join(store_root, os.path.splitext(os.path.basename(csv_file))[0])
+
+def _encode_labels(data, colors, presentations):
+    color_to_idx = {color: idx for idx, color in enumerate(colors)}
+    pres_to_idx = {pres: idx for idx, pres in enumerate(presentations)}
+
+    color_labels = np.zeros((len(data), len(colors)), dtype=np.float32)
+    pres_labels = np.zeros(len(data), dtype=np.int64)
+    for i in range(len(data)):
+        for color in data.iloc[i, 1].split(','):
+            if color in color_to_idx:
+                color_labels[i, color_to_idx[color]] = 1
+        pres_labels[i] = pres_to_idx[data.iloc[i, 2]]
+    return color_labels, pres_labels
+
+def _images_fingerprint(data, root_dir):
+    # Ảnh bị thay bằng file khác cùng tên không làm đổi CSV nên phải xét cả kích thước và
+    # thời điểm sửa của từng ảnh (chỉ stat, không đọc nội dung)
+    digest = hashlib.sha256()
+    for image in data.iloc[:, 0]:
+        try:
+            stat = os.stat(os.path.join(root_dir, image))
+            digest.update(f"{image}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+        except OSError:
+            digest.update(f"{image}|missing\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def _meta(csv_path, data, root_dir, image_size):
+    stat = os.stat(csv_path)
+    return {'csv': os.path.abspath(csv_path), 'csv_size': stat.st_size, 'csv_mtime_ns': stat.st_mtime_ns,
+            'images': _images_fingerprint(data, root_dir), 'image_size': image_size}
+
+def images_fingerprint(store_dir):
+    # Dấu vân tay ảnh nguồn lúc build kho, dùng làm khóa cho cache dựng từ kho (ví dụ đặc trưng)
+    with open(os.path.join(store_dir, 'meta.json'), encoding='utf-8') as f:
+        return json.load(f)['images']
+
+def is_fresh(csv_file, root_dir, out_dir, image_size=224):
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    csv_path = os.path.join(root_dir, csv_file)
+    stat = os.stat(csv_path)
+    if meta.get('csv_size') != stat.st_size or meta.get('csv_mtime_ns') != stat.st_mtime_ns:
+        return False
+    return all(meta.get(k) == v for k, v in _meta(csv_path, pd.read_csv(csv_path), root_dir, image_size).items())
+
+def build_store(csv_file, root_dir, out_dir, colors, presentations, image_size=224, workers=None):
+    csv_path = os.path.join(root_dir, csv_file)
+    data = pd.read_csv(csv_path)
+    # Lấy dấu vân tay trước khi đọc ảnh: ảnh bị sửa trong lúc build sẽ bị phát hiện ở lần sau
+    meta = {**_meta(csv_path, data, root_dir, image_size), 'count': len(data)}
+    os.makedirs(out_dir, exist_ok=True)
+    # meta.json chỉ được ghi sau khi mọi mảng đã ghi xong: xóa nó trước khi ghi đè để lần build
+    # bị ngắt giữa chừng để lại kho "chưa build" chứ không phải kho hỏng trông như còn hợp lệ
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(data), image_size, image_size, 3))
+
+    def load(i):
+        img_path = os.path.join(root_dir, data.iloc[i, 0])
+        with Image.open(img_path) as img:
+            images[i] = np.asarray(img.convert('RGB').resize((image_size, image_size), Image.BILINEAR))
+
+    # PIL nhả GIL khi giải mã/resize nên dùng luồng là đủ để chạy song song
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        list(pool.map(load, range(len(data))))
+    images.flush()
+    del images
+
+    color_labels, pres_labels = _encode_labels(data, colors, presentations)
+    np.save(os.path.join(out_dir, 'colors.npy'), color_labels)
+    np.save(os.path.join(out_dir, 'presentations.npy'), pres_labels)
+    atomic_write_json(meta_path, meta)
+    return out_dir
+
+def ensure_store(csv_file, root_dir, colors, presentations, image_size=224, store_root=DEFAULT_STORE_DIR, rebuild=False):
+    out_dir = store_path(csv_file, store_root)
+    if rebuild or not is_fresh(csv_file, root_dir, out_dir, image_size):
+        build_store(csv_file, root_dir, out_dir, colors, presentations, image_size)
+    return out_dir
+
+class CachedFlowerDataset(Dataset):
+    # transform nhận tensor uint8 (C x H x W); ảnh được mở bằng mmap trong từng worker
+    def __init__(self, store_dir, transform=None):
+        self.store_dir = store_dir
+        self.transform = transform
+        self.color_labels = torch.from_numpy(np.load(os.path.join(store_dir, 'colors.npy')))
+        self.pres_labels = torch.from_numpy(np.load(os.path.join(store_dir, 'presentations.npy')))
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.store_dir, 'images.npy'), mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        # Không gửi memory-map sang các worker của DataLoader, mỗi worker tự mở lại
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.pres_labels)
+
+    def __getitem__(self, idx):
+        image = torch.from_numpy(np.array(self.images[idx])).permute(2, 0, 1)
+        if self.transform:
+            image = self.transform(image)
+        return image, self.color_labels[idx], self.pres_labels[idx]
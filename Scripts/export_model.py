@@ -0,0 +1,114 @@
+﻿import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+import torch
+import torch.nn as nn
+
+import flower_model
+from analysis_common import ARTIFACT_PATH, COLORS, MODEL_PATH, PRESENTATIONS, ROOT_DIR
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Xuất best_model.pth thành artifact tối ưu cho CPU (TorchScript):
+# - backbone ResNet-50 lượng tử hóa tĩnh int8 (fuse conv/bn/relu, hiệu chỉnh bằng ảnh thật)
+# - các lớp Linear (fc, color_head, pres_head) lượng tử hóa động int8
+# inference.py tự động dùng artifact này khi có.
+
+class QuantizableFlowerModel(nn.Module):
+    def __init__(self, fp32_model, quantize_backbone=True):
+        super(QuantizableFlowerModel, self).__init__()
+        if quantize_backbone:
+            from torchvision.models.quantization import resnet50 as quantizable_resnet50
+            self.resnet = quantizable_resnet50(weights=None, quantize=False)
+            self.resnet.fc = nn.Identity()
+            self.resnet.load_state_dict(fp32_model.resnet.state_dict())
+        else:
+            self.resnet = fp32_model.resnet
+        self.fc = fp32_model.fc
+        self.color_head = fp32_model.color_head
+        self.pres_head = fp32_model.pres_head
+
+    def forward(self, x):
+        x = self.resnet(x)
+        x = self.fc(x)
+        color_out = torch.sigmoid(self.color_head(x))
+        pres_out = self.pres_head(x)
+        return color_out, pres_out
+
+def load_fp32_model():
+    model = flower_model.FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS))
+    model.load_state_dict(torch.load(MODEL_PATH, map_location='cpu'))
+    model.eval()
+    return model
+
+def calibration_images(csv_files, limit):
+    images = []
+    for csv_file in csv_files:
+        for image_path in pd.read_csv(os.path.join(ROOT_DIR, csv_file)).iloc[:, 0]:
+            if len(images) >= limit:
+                return images
+            try:
+                images.append(flower_model.load_image(os.path.join(ROOT_DIR, image_path)))
+            except Exception:
+                continue
+    return images
+
+def _select_quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("PyTorch không hỗ trợ lượng tử hóa trên máy này")
+
+def export(output_path=ARTIFACT_PATH, quantize_backbone=True, calibration_limit=64, batch_size=16):
+    torch.set_grad_enabled(False)
+    engine = _select_quantized_engine()
+    model = QuantizableFlowerModel(load_fp32_model(), quantize_backbone)
+    model.eval()
+
+    if quantize_backbone:
+        images = calibration_images(['data/train.csv', 'data/val.csv'], calibration_limit)
+        if not images:
+            raise RuntimeError("Không có ảnh nào để hiệu chỉnh lượng tử hóa")
+
+        model.resnet.fuse_model()
+        model.resnet.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+        torch.ao.quantization.prepare(model.resnet, inplace=True)
+        for i in range(0, len(images), batch_size):
+            model.resnet(torch.stack(images[i:i + batch_size]))
+        torch.ao.quantization.convert(model.resnet, inplace=True)
+
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    example = torch.zeros(1, 3, 224, 224)
+    scripted = torch.jit.trace(model, example)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    scripted.save(output_path)
+
+    return {
+        'success': True,
+        'artifact': os.path.abspath(output_path),
+        'engine': engine,
+        'quantized_backbone': quantize_backbone,
+        'size_mb': os.path.getsize(output_path) / (1024 * 1024)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Xuất FlowerModel thành artifact TorchScript lượng tử hóa cho CPU')
+    parser.add_argument('--output', default=ARTIFACT_PATH)
+    parser.add_argument('--fp32-backbone', action='store_true', help='Giữ backbone fp32, chỉ lượng tử hóa các lớp Linear')
+    parser.add_argument('--calibration-images', type=int, default=64)
+    args = parser.parse_args()
+
+    try:
+        result = export(args.output, not args.fp32_backbone, args.calibration_images)
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
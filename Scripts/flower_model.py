@@ -0,0 +1,113 @@
+﻿import io
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import models, transforms
+
+from analysis_common import ARTIFACT_PATH, COLORS, MODEL_PATH, PRESENTATIONS, WORKING_SIZE, check_decode_budget
+
+# Engine suy luận (PyTorch/torchvision). inference.py chỉ import module này khi ảnh
+# hợp lệ và kết quả chưa có trong cache.
+
+# Định nghĩa mô hình
+class FlowerModel(nn.Module):
+    def __init__(self, num_colors, num_presentations):
+        super(FlowerModel, self).__init__()
+        self.resnet = models.resnet50(weights=None)  # Thay pretrained=False bằng weights=None
+        self.resnet.fc = nn.Identity()
+        self.fc = nn.Sequential(
+            nn.Linear(2048, 512),
+            nn.ReLU(),
+            nn.Dropout(0.5),
+            nn.Linear(512, 256),
+            nn.ReLU(),
+            nn.Dropout(0.5)
+        )
+        self.color_head = nn.Linear(256, num_colors)
+        self.pres_head = nn.Linear(256, num_presentations)
+
+    def forward(self, x):
+        x = self.resnet(x)
+        x = self.fc(x)
+        color_out = torch.sigmoid(self.color_head(x))
+        pres_out = self.pres_head(x)
+        return color_out, pres_out
+
+# Tiền xử lý ảnh
+transform = transforms.Compose([
+    transforms.Resize((224, 224)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+# Mô hình chỉ được nạp một lần cho mỗi tiến trình
+_loaded_model = None
+
+def use_artifact():
+    # Chỉ dùng artifact khi chạy trên CPU và artifact không cũ hơn best_model.pth
+    if torch.cuda.is_available() or os.environ.get('BLOOMIE_DISABLE_ARTIFACT') == '1':
+        return False
+    if not os.path.exists(ARTIFACT_PATH):
+        return False
+    return not os.path.exists(MODEL_PATH) or os.path.getmtime(ARTIFACT_PATH) >= os.path.getmtime(MODEL_PATH)
+
+def load_model():
+    global _loaded_model
+    if _loaded_model is None and use_artifact():
+        model = torch.jit.load(ARTIFACT_PATH, map_location='cpu')
+        model.eval()
+        _loaded_model = (model, torch.device('cpu'))
+    if _loaded_model is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        model = FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS)).to(device)
+        model.load_state_dict(torch.load(MODEL_PATH, map_location=device))
+        model.eval()
+        _loaded_model = (model, device)
+    return _loaded_model
+
+def load_image(image):
+    # image: đường dẫn file, bytes của ảnh hoặc file-like object
+    source = None
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        data = bytes(image)
+    elif hasattr(image, 'read'):
+        data = image.read()
+    else:
+        source = image
+        with open(image, 'rb') as f:
+            data = f.read()
+    check_decode_budget(data, source)
+    img = Image.open(io.BytesIO(data))
+    # JPEG được giải mã thu nhỏ (1/2 .. 1/8) ngay từ đầu, giống IMREAD_REDUCED_* bên image_engine,
+    # nên ảnh nhiều megapixel không bao giờ được giải mã đầy đủ vào bộ nhớ
+    size = max(WORKING_SIZE, 224)
+    img.draft('RGB', (size, size))
+    return transform(img.convert('RGB'))
+
+def decode_outputs(color_probs, pres_probs):
+    top_color_indices = np.argsort(color_probs)[-4:][::-1]
+    colors = [COLORS[i] for i in top_color_indices if color_probs[i] > 0.5]
+    if not colors:
+        colors = [COLORS[top_color_indices[0]]]
+
+    presentation = PRESENTATIONS[np.argmax(pres_probs)]
+
+    return {
+        'success': True,
+        'colors': colors,
+        'presentation': presentation
+    }
+
+def predict_batch(images):
+    model, device = load_model()
+    batch = torch.stack(images).to(device)
+
+    with torch.no_grad():
+        color_out, pres_out = model(batch)
+
+    color_probs = color_out.cpu().numpy()
+    pres_probs = torch.softmax(pres_out, dim=1).cpu().numpy()
+    return [decode_outputs(color_probs[i], pres_probs[i]) for i in range(len(images))]
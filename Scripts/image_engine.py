@@ -0,0 +1,314 @@
+﻿import cv2
+import numpy as np
+from functools import cached_property
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from skimage import color
+from analysis_common import (DEFAULT_COLOR_MODE, WORKING_SIZE, check_decode_budget, read_image_bytes, reduction_factor,
+                             sniff_mime_type, validate_color_mode, validate_image_bytes)
+from analysis_logging import stage
+
+# Engine phân tích ảnh (OpenCV, scikit-learn, scikit-image). analyze_image.py chỉ import
+# module này sau khi đầu vào đã hợp lệ và không có sẵn kết quả trong cache.
+
+COLOR_PALETTE = {
+    'đỏ': [255, 0, 0], 'đỏ đậm': [139, 0, 0], 'đỏ tươi': [255, 69, 0], 'đỏ cherry': [222, 49, 99], 'đỏ rượu': [153, 0, 0],
+    'đỏ hồng': [255, 99, 71], 'hồng': [255, 192, 203], 'hồng nhạt': [255, 182, 193], 'hồng đậm': [255, 105, 180],
+    'hồng phấn': [255, 204, 204], 'hồng đào': [255, 218, 185], 'hồng san hô': [255, 127, 127], 'hồng cẩm chướng': [255, 153, 204],
+    'hồng dâu': [255, 105, 97], 'hồng phai': [219, 112, 147], 'hồng sen': [255, 145, 164], 'trắng': [255, 255, 255],
+    'trắng kem': [255, 245, 238], 'kem': [255, 253, 208], 'trắng ngọc trai': [240, 248, 255], 'trắng sữa': [245, 245, 220],
+    'vàng': [255, 255, 0], 'vàng nhạt': [255, 255, 224], 'vàng đậm': [255, 215, 0], 'vàng cam': [255, 195, 0],
+    'vàng cúc': [255, 228, 181], 'vàng mù tạt': [255, 219, 88], 'vàng ánh kim': [255, 215, 0], 'vàng đồng tiền': [255, 223, 0],
+    'cam': [255, 165, 0], 'cam cháy': [255, 140, 0], 'cam đào': [255, 178, 128], 'cam san hô': [255, 160, 122],
+    'cam đất': [255, 127, 80], 'cam rực': [255, 117, 24], 'tím': [128, 0, 128], 'tím nhạt': [230, 230, 250],
+    'tím violet': [238, 130, 238], 'tím đậm': [102, 51, 153], 'tím oải hương': [204, 153, 255], 'tím lan': [186, 85, 211],
+    'tím mộng mơ': [221, 160, 221], 'tím hoàng gia': [75, 0, 130], 'tím huệ': [147, 112, 219], 'xanh dương': [0, 0, 255],
+    'xanh dương nhạt': [173, 216, 230], 'xanh ngọc': [64, 224, 208], 'xanh biển': [0, 105, 148], 'xanh cobalt': [0, 71, 171],
+    'xanh sapphire': [15, 82, 186], 'xanh cẩm tú cầu': [135, 206, 250], 'xanh bạc hà': [152, 255, 152], 'xanh lam': [70, 130, 180],
+    'xanh lá': [0, 128, 0], 'xanh lá nhạt': [144, 238, 144], 'xanh olive': [107, 142, 35], 'xanh rêu': [47, 79, 79],
+    'xanh pastel': [189, 252, 201], 'xanh đậm': [0, 100, 0], 'xanh lá mạ': [124, 252, 0], 'nâu': [165, 42, 42],
+    'nâu nhạt': [210, 180, 140], 'nâu socola': [139, 69, 19], 'nâu cà phê': [111, 78, 55], 'nâu đất': [139, 69, 19],
+    'xám': [128, 128, 128], 'xám nhạt': [211, 211, 211], 'đen': [0, 0, 0]
+}
+
+UNKNOWN_COLOR = 'không xác định'
+MAX_COLOR_DISTANCE = 35
+
+# Bảng màu tham chiếu được chuyển sang không gian Lab một lần khi import
+_PALETTE_NAMES = list(COLOR_PALETTE.keys())
+_PALETTE_LAB = color.rgb2lab(
+    (np.array(list(COLOR_PALETTE.values()), dtype=np.float32) / 255.0).reshape(-1, 1, 3)
+).reshape(-1, 3)
+_MATCH_CHUNK_SIZE = 4096
+
+def map_rgb_array_to_indices(rgb_array):
+    # Trả về chỉ số màu trong bảng màu cho từng pixel, -1 nếu không đủ gần màu nào
+    rgb_array = np.asarray(rgb_array).reshape(-1, 3)
+    indices = np.full(len(rgb_array), -1, dtype=np.int64)
+    if len(rgb_array) == 0:
+        return indices
+
+    lab = color.rgb2lab((rgb_array.astype(np.float32) / 255.0).reshape(-1, 1, 3)).reshape(-1, 3)
+    for i in range(0, len(lab), _MATCH_CHUNK_SIZE):
+        chunk = lab[i:i + _MATCH_CHUNK_SIZE]
+        distances = np.sqrt(np.sum((chunk[:, None, :] - _PALETTE_LAB[None, :, :]) ** 2, axis=2))
+        closest = np.argmin(distances, axis=1)
+        min_distances = distances[np.arange(len(chunk)), closest]
+        indices[i:i + len(chunk)] = np.where(min_distances > MAX_COLOR_DISTANCE, -1, closest)
+    return indices
+
+def map_rgb_array_to_names(rgb_array):
+    return [UNKNOWN_COLOR if j < 0 else _PALETTE_NAMES[j] for j in map_rgb_array_to_indices(rgb_array)]
+
+def map_rgb_to_name(rgb):
+    return map_rgb_array_to_names([rgb])[0]
+
+ANALYSIS_SIZE = (224, 224)
+
+_REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                         4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+# Ảnh được giải mã một lần, các ảnh trung gian được tính khi cần và dùng chung
+# cho cả bước phân tích màu và bước phân loại kiểu trình bày. original đã được giới hạn
+# ở WORKING_SIZE nên CLAHE/làm mịn không chạy trên ảnh gốc nhiều megapixel.
+class DecodedImage:
+    def __init__(self, original):
+        self.original = original
+
+    @cached_property
+    def bgr(self):
+        return cv2.resize(self.original, ANALYSIS_SIZE)
+
+    @cached_property
+    def rgb(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB)
+
+    @cached_property
+    def hsv(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def lab(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2LAB)
+
+    @cached_property
+    def gray(self):
+        return cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+
+    @cached_property
+    def enhanced(self):
+        # Tiền xử lý: Chuẩn hóa ánh sáng và làm mịn
+        with stage('clahe_blur'):
+            img_lab = cv2.cvtColor(self.original, cv2.COLOR_BGR2LAB)
+            l, a, b = cv2.split(img_lab)
+            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+            l = clahe.apply(l)
+            img_lab = cv2.merge((l, a, b))
+            img = cv2.cvtColor(img_lab, cv2.COLOR_LAB2BGR)
+            img = cv2.GaussianBlur(img, (5, 5), 0)
+            return cv2.resize(img, ANALYSIS_SIZE)
+
+    @cached_property
+    def enhanced_hsv(self):
+        return cv2.cvtColor(self.enhanced, cv2.COLOR_BGR2HSV)
+
+def _limit_size(img, working_size):
+    height, width = img.shape[:2]
+    if not working_size or max(height, width) <= working_size:
+        return img
+    scale = working_size / max(height, width)
+    return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+def decode_image(data, source=None, working_size=WORKING_SIZE):
+    # source chỉ dùng cho thông báo lỗi khi bytes được đọc từ file
+    validate_image_bytes(data, source)
+    dimensions = check_decode_budget(data, source)
+
+    # JPEG được giải mã thẳng ở 1/2, 1/4 hoặc 1/8 kích thước, các định dạng khác giải mã đầy đủ
+    flag = cv2.IMREAD_COLOR
+    if sniff_mime_type(data) == 'image/jpeg':
+        flag = _REDUCED_DECODE_FLAGS[reduction_factor(dimensions, working_size)]
+    with stage('decode'):
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise ValueError(f"Không thể đọc ảnh tại: {source}" if source else "Không thể đọc ảnh từ dữ liệu tải lên")
+    with stage('downscale'):
+        img = _limit_size(img, working_size)
+    return DecodedImage(img)
+
+def load_image(source):
+    # source: đường dẫn file, bytes của ảnh hoặc DecodedImage đã giải mã
+    if isinstance(source, DecodedImage):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return decode_image(bytes(source))
+    return decode_image(read_image_bytes(source), source)
+
+def _grabcut_mask(img):
+    # Phân đoạn hoa bằng GrabCut
+    mask = np.zeros(img.shape[:2], np.uint8)
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+    rect = (10, 10, img.shape[1]-10, img.shape[0]-10)
+    cv2.grabCut(img, mask, rect, bgd_model, fgd_model, 5, cv2.GC_INIT_WITH_RECT)
+    return np.where((mask == 2) | (mask == 0), 0, 1).astype('uint8')
+
+def _center_mask(img):
+    # Chế độ nhanh: thay GrabCut bằng vùng elip ở giữa ảnh, nơi hoa thường nằm
+    height, width = img.shape[:2]
+    mask = np.zeros((height, width), np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (int(width * 0.45), int(height * 0.45)), 0, 0, 360, 1, -1)
+    return mask
+
+def _cluster_colors(pixels, num_colors, mode):
+    if mode == 'fast':
+        if len(pixels) > 4000:
+            indices = np.random.choice(len(pixels), 4000, replace=False)
+            pixels = pixels[indices]
+        kmeans = MiniBatchKMeans(n_clusters=num_colors, random_state=42, n_init=3, batch_size=1024)
+    else:
+        if len(pixels) > 10000:
+            indices = np.random.choice(len(pixels), 10000, replace=False)
+            pixels = pixels[indices]
+        kmeans = KMeans(n_clusters=num_colors, random_state=42, n_init=20)
+    kmeans.fit(pixels)
+    return kmeans.cluster_centers_.astype(int), kmeans.labels_
+
+def get_dominant_colors(image, num_colors=6, exclude_background=True, mode=DEFAULT_COLOR_MODE):
+    try:
+        validate_color_mode(mode)
+
+        decoded = load_image(image)
+        img = decoded.enhanced
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        
+        if mode == 'fast':
+            with stage('center_mask'):
+                mask2 = _center_mask(img)
+        else:
+            with stage('grabcut'):
+                mask2 = _grabcut_mask(img)
+        
+        # Chuyển sang HSV để tạo mặt nạ bổ sung
+        img_hsv = decoded.enhanced_hsv
+        lower_white = np.array([0, 0, 210])
+        upper_white = np.array([180, 15, 255])
+        lower_black = np.array([0, 0, 0])
+        upper_black = np.array([180, 255, 30])
+        lower_gray = np.array([0, 0, 50])
+        upper_gray = np.array([180, 25, 200])
+        mask_white = cv2.inRange(img_hsv, lower_white, upper_white)
+        mask_black = cv2.inRange(img_hsv, lower_black, upper_black)
+        mask_gray = cv2.inRange(img_hsv, lower_gray, upper_gray)
+        mask_hsv = cv2.bitwise_not(mask_white + mask_black + mask_gray)
+        
+        # Ưu tiên vùng có độ bão hòa cao
+        saturation = img_hsv[:, :, 1]
+        sat_mask = cv2.inRange(saturation, 60, 255)
+        final_mask = cv2.bitwise_and(mask2, mask_hsv, mask=sat_mask)
+        
+        # Áp dụng mặt nạ
+        masked_img = cv2.bitwise_and(img_rgb, img_rgb, mask=final_mask)
+        pixels = masked_img.reshape(-1, 3)
+        valid_pixels = pixels[np.any(pixels != [0, 0, 0], axis=1)]
+        
+        if len(valid_pixels) < 100:
+            raise ValueError("Không đủ pixel hợp lệ sau khi phân đoạn")
+        
+        with stage('kmeans'):
+            colors, labels = _cluster_colors(valid_pixels, num_colors, mode)
+        color_counts = np.bincount(labels)
+        color_proportions = color_counts / len(labels)
+        
+        sorted_indices = np.argsort(color_proportions)[::-1]
+        with stage('palette'):
+            color_names = map_rgb_array_to_names(colors)
+        final_colors = []
+        for i in sorted_indices:
+            color_name = color_names[i]
+            if exclude_background and color_name in ['trắng', 'đen', 'xám', 'xám nhạt', 'trắng kem', 'trắng sữa'] and color_proportions[i] > 0.15:
+                continue
+            if color_name != UNKNOWN_COLOR:
+                final_colors.append(color_name)
+        
+        if not final_colors and colors.any():
+            final_colors.append(color_names[sorted_indices[0]])
+        
+        return list(set(final_colors))[:4]
+    except Exception as e:
+        raise Exception(f"Lỗi khi phân tích màu sắc: {str(e)}")
+
+PRESENTATION_FEATURES = ['aspect_ratio', 'edge_density', 'contour_count', 'bright_ratio', 'symmetry', 'border_uniformity']
+
+def extract_presentation_features(images):
+    # images: danh sách đường dẫn, bytes hoặc DecodedImage; trả về mảng (N, len(PRESENTATION_FEATURES))
+    decoded = [load_image(image) for image in images]
+    if not decoded:
+        return np.zeros((0, len(PRESENTATION_FEATURES)), dtype=np.float64)
+
+    gray = np.stack([d.gray for d in decoded])
+    count, height, width = gray.shape
+    area = height * width
+    aspect_ratio = np.full(count, width / height)
+
+    # Mật độ biên (tổng giá trị biên 0/255 trên diện tích, giữ nguyên thang đo của các ngưỡng)
+    edges = np.stack([cv2.Canny(g, 100, 200) for g in gray])
+    edge_density = edges.sum(axis=(1, 2), dtype=np.float64) / area
+
+    # Số lượng đường viền trên mặt nạ vùng không phải nền trắng
+    thresh = np.where(gray > 240, 0, 255).astype(np.uint8)
+    contour_count = np.array([len(cv2.findContours(t, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]) for t in thresh],
+                             dtype=np.float64)
+
+    # Tỷ lệ vùng sáng
+    brightness = np.stack([d.hsv[:, :, 2] for d in decoded])
+    bright_ratio = np.count_nonzero(brightness > 210, axis=(1, 2)) / area
+
+    # Độ đối xứng trái/phải; ép kiểu int16 để phép trừ không bị tràn số uint8
+    half = width // 2
+    left_half = gray[:, :, :half].astype(np.int16)
+    right_half_flipped = gray[:, :, ::-1][:, :, :half].astype(np.int16)
+    symmetry = 1.0 - np.abs(left_half - right_half_flipped).mean(axis=(1, 2)) / 255.0
+
+    # Độ đồng nhất màu nền: tỷ lệ pixel viền thuộc màu viền phổ biến nhất
+    rgb = np.stack([d.rgb for d in decoded])
+    border_pixels = np.concatenate([rgb[:, 0, :], rgb[:, -1, :], rgb[:, :, 0], rgb[:, :, -1]], axis=1)
+    border_length = border_pixels.shape[1]
+    with stage('palette'):
+        border_indices = map_rgb_array_to_indices(border_pixels).reshape(count, border_length)
+    palette_size = len(_PALETTE_NAMES)
+    rows = np.repeat(np.arange(count), border_length)
+    flat = border_indices.ravel()
+    known = flat >= 0
+    counts = np.bincount(rows[known] * palette_size + flat[known], minlength=count * palette_size)
+    border_uniformity = counts.reshape(count, palette_size).max(axis=1) / border_length
+
+    return np.column_stack([aspect_ratio, edge_density, contour_count, bright_ratio, symmetry, border_uniformity])
+
+def classify_presentation_features(features):
+    # Quy tắc phân loại áp dụng trên cả lô; np.select chọn điều kiện đúng đầu tiên như chuỗi if/elif
+    features = np.atleast_2d(features)
+    aspect_ratio, edge_density, contour_count, bright_ratio, symmetry, border_uniformity = features.T
+    is_square = (aspect_ratio > 0.9) & (aspect_ratio < 1.1)
+    rules = [
+        ((aspect_ratio < 0.7) & (edge_density < 0.08), "Bó hoa"),
+        ((aspect_ratio < 0.7) & (edge_density >= 0.08), "Hoa bó cổ điển"),
+        (is_square & (contour_count > 25) & (symmetry < 0.8), "Giỏ hoa"),
+        (is_square & (contour_count <= 25) & (symmetry >= 0.8), "Giỏ hoa hiện đại"),
+        ((aspect_ratio > 1.5) & (edge_density < 0.07) & (border_uniformity > 0.7), "Hộp hoa"),
+        ((aspect_ratio > 1.5) & (edge_density >= 0.07), "Hộp hoa nghệ thuật"),
+        ((edge_density > 0.18) & (contour_count > 35), "Lẵng hoa"),
+        ((edge_density > 0.18) & (contour_count <= 35), "Lẵng hoa mini"),
+        ((bright_ratio > 0.35) & (contour_count < 8), "Bình hoa"),
+    ]
+    labels = [label for _, label in rules] + ["Hoa để bàn"]
+    choice = np.select([condition for condition, _ in rules], np.arange(len(rules)), default=len(rules))
+    return [labels[i] for i in choice]
+
+def classify_presentations(images):
+    try:
+        return classify_presentation_features(extract_presentation_features(images))
+    except Exception as e:
+        raise Exception(f"Lỗi khi phân loại kiểu trình bày: {str(e)}")
+
+def classify_presentation(image):
+    return classify_presentations([image])[0]
@@ -1,87 +1,50 @@
-﻿import torch
-import torch.nn as nn
-from torchvision import transforms
-from torchvision import models
-from PIL import Image
-import numpy as np
-import sys
+﻿import sys
 import json
 import os
+import analysis_cache
+from analysis_common import ARTIFACT_PATH, MODEL_PATH, check_decode_budget, read_image_bytes, validate_image_bytes
 
 # Cấu hình stdout để sử dụng UTF-8
 sys.stdout.reconfigure(encoding='utf-8')
 
-# Định nghĩa danh sách màu và kiểu trình bày
-COLORS = ['đỏ', 'đỏ đậm', 'đỏ tươi', 'đỏ cherry', 'đỏ rượu', 'đỏ hồng', 'h hồng', 'hồng nhạt', 'hồng đậm', 'hồng phấn',
-          'hồng đào', 'hồng san hô', 'hồng cẩm chướng', 'hồng dâu', 'hồng phai', 'hồng sen', 'trắng', 'trắng kem', 'kem',
-          'trắng ngọc trai', 'trắng sữa', 'vàng', 'vàng nhạt', 'vàng đậm', 'vàng cam', 'vàng cúc', 'vàng mù tạt',
-          'vàng ánh kim', 'vàng đồng tiền', 'cam', 'cam cháy', 'cam đào', 'cam san hô', 'cam đất', 'cam rực', 'tím',
-          'tím nhạt', 'tím violet', 'tím đậm', 'tím oải hương', 'tím lan', 'tím mộng mơ', 'tím hoàng gia', 'tím huệ',
-          'xanh dương', 'xanh dương nhạt', 'xanh ngọc', 'xanh biển', 'xanh cobalt', 'xanh sapphire', 'xanh cẩm tú cầu',
-          'xanh bạc hà', 'xanh lam', 'xanh lá', 'xanh lá nhạt', 'xanh olive', 'xanh rêu', 'xanh pastel', 'xanh đậm',
-          'xanh lá mạ', 'nâu', 'nâu nhạt', 'nâu socola', 'nâu cà phê', 'nâu đất', 'xám', 'xám nhạt', 'đen']
-PRESENTATIONS = ['Bó hoa', 'Hoa bó cổ điển', 'Giỏ hoa', 'Giỏ hoa hiện đại', 'Hộp hoa', 'Hộp hoa nghệ thuật',
-                 'Lẵng hoa', 'Lẵng hoa mini', 'Bình hoa', 'Hoa để bàn']
+# Lớp CLI/kiểm tra đầu vào chỉ dùng thư viện chuẩn; PyTorch trong flower_model.py chỉ
+# được import khi ảnh hợp lệ và kết quả chưa có trong cache.
 
-# Định nghĩa mô hình
-class FlowerModel(nn.Module):
-    def __init__(self, num_colors, num_presentations):
-        super(FlowerModel, self).__init__()
-        self.resnet = models.resnet50(weights=None)  # Thay pretrained=False bằng weights=None
-        self.resnet.fc = nn.Identity()
-        self.fc = nn.Sequential(
-            nn.Linear(2048, 512),
-            nn.ReLU(),
-            nn.Dropout(0.5),
-            nn.Linear(512, 256),
-            nn.ReLU(),
-            nn.Dropout(0.5)
-        )
-        self.color_head = nn.Linear(256, num_colors)
-        self.pres_head = nn.Linear(256, num_presentations)
+def model_version():
+    # Phiên bản mô hình dựa trên kích thước và thời điểm sửa của cả file trọng số lẫn
+    # artifact, không cần import torch hay nạp mô hình để tra cache
+    parts = []
+    for path in (MODEL_PATH, ARTIFACT_PATH):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}-{stat.st_mtime_ns}")
+        else:
+            parts.append('none')
+    if os.environ.get('BLOOMIE_DISABLE_ARTIFACT') == '1':
+        parts.append('no-artifact')
+    return '-'.join(parts)
 
-    def forward(self, x):
-        x = self.resnet(x)
-        x = self.fc(x)
-        color_out = torch.sigmoid(self.color_head(x))
-        pres_out = self.pres_head(x)
-        return color_out, pres_out
+def cache_key(data, version=None):
+    # version: phiên bản của mô hình đang nằm trong bộ nhớ (tiến trình chạy lâu dài); mặc định đọc từ file
+    return analysis_cache.content_key(data, f"predict-{version or model_version()}")
 
-# Tiền xử lý ảnh
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
-
-def predict(image_path):
+def predict(image_path, use_cache=True):
     try:
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        model = FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS)).to(device)
-        model_path = os.path.join(os.path.dirname(__file__), "..", "Models", "best_model.pth")
-        model.load_state_dict(torch.load(model_path, map_location=device))
-        model.eval()
-
-        img = Image.open(image_path).convert('RGB')
-        img = transform(img).unsqueeze(0).to(device)
-
-        with torch.no_grad():
-            color_out, pres_out = model(img)
-        
-        color_probs = color_out[0].cpu().numpy()
-        top_color_indices = np.argsort(color_probs)[-4:][::-1]
-        colors = [COLORS[i] for i in top_color_indices if color_probs[i] > 0.5]
-        if not colors:
-            colors = [COLORS[top_color_indices[0]]]
+        source = None if isinstance(image_path, (bytes, bytearray, memoryview)) else image_path
+        data = validate_image_bytes(read_image_bytes(image_path), source)
+        check_decode_budget(data, source)
+        cache = analysis_cache.get_cache() if use_cache else None
+        key = cache_key(data) if cache is not None else None
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
 
-        pres_probs = torch.softmax(pres_out, dim=1)[0].cpu().numpy()
-        presentation = PRESENTATIONS[np.argmax(pres_probs)]
-
-        return {
-            'success': True,
-            'colors': colors,
-            'presentation': presentation
-        }
+        import flower_model
+        result = flower_model.predict_batch([flower_model.load_image(data)])[0]
+        if cache is not None:
+            cache.put(key, result)
+        return result
     except Exception as e:
         return {
             'success': False,
@@ -0,0 +1,250 @@
+﻿import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import analysis_cache
+import flower_model
+import inference
+from analysis_common import read_image_bytes, validate_image_bytes
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Dịch vụ suy luận thường trú: nạp FlowerModel một lần, gom các request đồng thời
+# thành micro-batch (tối đa max_batch_size ảnh hoặc chờ tối đa max_wait_ms) rồi chạy
+# một lần forward cho cả batch.
+# POST /similar trả về các sản phẩm có ảnh tương tự (chỉ mục của product_index.py).
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5056
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+class InferenceService:
+    def __init__(self, max_batch_size=16, max_wait_ms=10.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+        self._requests = 0
+        self._batches = 0
+        self._busy_seconds = 0.0
+        self._queue_waits = deque(maxlen=1000)
+        self._batch_sizes = deque(maxlen=1000)
+        self._cache = analysis_cache.get_cache()
+        self._cache_hits = 0
+        # Khóa cache gắn với phiên bản mô hình lúc nạp, không phải file trọng số hiện tại:
+        # sau khi huấn luyện lại, server vẫn dự đoán bằng mô hình cũ cho đến khi khởi động lại
+        self.model_version = inference.model_version()
+        flower_model.load_model()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, image):
+        # image: đường dẫn file hoặc bytes của ảnh; tiền xử lý chạy ở luồng gọi
+        data = validate_image_bytes(read_image_bytes(image))
+        future = Future()
+        key = inference.cache_key(data, self.model_version) if self._cache is not None else None
+        if key is not None:
+            cached = self._cache.get(key)
+            if cached is not None:
+                with self._lock:
+                    self._cache_hits += 1
+                future.set_result(cached)
+                return future
+
+        tensor = flower_model.load_image(data)
+        self._queue.put((tensor, future, time.perf_counter(), key))
+        return future
+
+    def predict(self, image, timeout=None):
+        try:
+            return self.submit(image).result(timeout=timeout)
+        except Exception as e:
+            return {'success': False, 'message': str(e)}
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            try:
+                results = flower_model.predict_batch([tensor for tensor, _, _, _ in batch])
+            except Exception as e:
+                results = [{'success': False, 'message': str(e)}] * len(batch)
+            finished = time.perf_counter()
+
+            with self._lock:
+                self._requests += len(batch)
+                self._batches += 1
+                self._busy_seconds += finished - started
+                self._batch_sizes.append(len(batch))
+                self._queue_waits.extend(started - enqueued for _, _, enqueued, _ in batch)
+
+            for (_, future, _, key), result in zip(batch, results):
+                if key is not None and result.get('success'):
+                    try:
+                        self._cache.put(key, result)
+                    except Exception:
+                        pass  # luồng gom batch không được dừng vì lỗi cache
+                future.set_result(result)
+
+    def metrics(self):
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            uptime = time.perf_counter() - self._started_at
+
+            def percentile(p):
+                if not waits:
+                    return 0.0
+                return waits[min(len(waits) - 1, int(p / 100.0 * len(waits)))] * 1000
+
+            return {
+                'requests': self._requests,
+                'cache_hits': self._cache_hits,
+                'batches': self._batches,
+                'queue_depth': self._queue.qsize(),
+                'avg_batch_size': sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else 0.0,
+                'throughput_images_per_sec': self._requests / uptime if uptime > 0 else 0.0,
+                'busy_images_per_sec': self._requests / self._busy_seconds if self._busy_seconds > 0 else 0.0,
+                'queue_wait_ms_p50': percentile(50),
+                'queue_wait_ms_p95': percentile(95),
+                'queue_wait_ms_max': waits[-1] * 1000 if waits else 0.0,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000
+            }
+
+class SimilarityService:
+    # Tìm sản phẩm tương tự (product_index.py) ngay trong server: mô hình nhúng và chỉ mục
+    # được nạp một lần rồi giữ trong bộ nhớ, chỉ mục được nạp lại khi file trên đĩa thay đổi
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_mtime = None
+
+    def _current_index(self):
+        import product_index
+        index_dir = self.index_dir or product_index.INDEX_DIR
+        meta_path = os.path.join(index_dir, 'meta.json')
+        with self._lock:
+            mtime = os.stat(meta_path).st_mtime_ns
+            if self._index is None or mtime != self._loaded_mtime:
+                self._index = product_index.ProductIndex.load(index_dir)
+                self._loaded_mtime = mtime
+            return self._index
+
+    def query(self, image, k=10):
+        try:
+            data = validate_image_bytes(read_image_bytes(image))
+            import product_index
+            index = self._current_index()
+            return {
+                'success': True,
+                'stale': index.model_version != product_index.model_version(),
+                'results': index.query(data, k)
+            }
+        except FileNotFoundError:
+            return {'success': False, 'message': 'Chưa có chỉ mục sản phẩm, vui lòng chạy product_index.py build'}
+        except Exception as e:
+            return {'success': False, 'message': str(e)}
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    server_version = 'BloomieInference/1.0'
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'success': True})
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.service.metrics())
+        else:
+            self._send_json(404, {'success': False, 'message': 'Không tìm thấy đường dẫn'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path not in ('/predict', '/similar'):
+            self._send_json(404, {'success': False, 'message': 'Không tìm thấy đường dẫn'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send_json(400, {'success': False, 'message': 'Vui lòng cung cấp ảnh hoặc đường dẫn ảnh'})
+            return
+        if length > MAX_UPLOAD_BYTES:
+            self._send_json(413, {'success': False, 'message': 'Ảnh tải lên quá lớn'})
+            return
+
+        data = self.rfile.read(length)
+        content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        try:
+            k = parse_qs(url.query).get('k', [10])[0]
+            if content_type == 'application/json':
+                body = json.loads(data.decode('utf-8'))
+                image = body.get('path')
+                if not image:
+                    raise ValueError("Vui lòng cung cấp đường dẫn ảnh")
+                k = body.get('k', k)
+            else:
+                image = data
+            if url.path == '/similar':
+                result = self.server.similarity.query(image, int(k))
+            else:
+                result = self.server.service.predict(image)
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+
+        self._send_json(200, result)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, max_batch_size=16, max_wait_ms=10.0):
+    service = InferenceService(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    httpd = ThreadingHTTPServer((host, port), InferenceHandler)
+    httpd.service = service
+    httpd.similarity = SimilarityService()
+    print(json.dumps({'success': True, 'message': f'Đang lắng nghe tại http://{host}:{port}'}, ensure_ascii=False), flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Dịch vụ suy luận FlowerModel với micro-batching')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-batch-size', type=int, default=int(os.environ.get('INFERENCE_MAX_BATCH', 16)))
+    parser.add_argument('--max-wait-ms', type=float, default=float(os.environ.get('INFERENCE_MAX_WAIT_MS', 10)))
+    args = parser.parse_args()
+    serve(args.host, args.port, args.max_batch_size, args.max_wait_ms)
+
+if __name__ == '__main__':
+    main()
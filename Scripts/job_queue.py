@@ -0,0 +1,342 @@
+﻿import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from analysis_common import atomic_write_json
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Hàng đợi công việc phân tích ảnh qua thư mục: bên gọi ghi job vào pending/, tiến trình
+# worker nhận job bằng os.replace sang running/ (nguyên tử, không job nào bị nhận hai lần), chạy
+# trong một trong N tiến trình con đã nạp sẵn thư viện, rồi ghi kết quả vào done/.
+# - Số ảnh phân tích đồng thời cố định bằng --concurrency
+# - Job vượt quá thời gian cho phép bị hủy, tiến trình con bị kill và khởi động lại
+# - Khi pending/ đã có max_pending job, submit trả về "queue_full" thay vì xếp thêm
+# - Dừng worker (Ctrl-C) chờ các job đang chạy xong; job bị gián đoạn được trả lại pending/
+DEFAULT_QUEUE_DIR = os.environ.get(
+    'BLOOMIE_JOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'jobs'))
+DEFAULT_MAX_PENDING = int(os.environ.get('BLOOMIE_JOB_MAX_PENDING', '32'))
+DEFAULT_TIMEOUT = 60.0
+RESULT_RETENTION_SECONDS = 3600
+POLL_INTERVAL = 0.1
+# Khóa submit cũ hơn thời gian này là của tiến trình đã chết giữa chừng
+SUBMIT_LOCK_STALE_SECONDS = 10
+
+def _dirs(queue_dir):
+    return {name: os.path.join(queue_dir, name) for name in ('pending', 'running', 'done', 'inputs')}
+
+def _ensure_dirs(queue_dir):
+    dirs = _dirs(queue_dir)
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+def _read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _job_files(directory):
+    # Tên job bắt đầu bằng thời điểm gửi nên sắp xếp theo tên là thứ tự FIFO
+    return sorted(name for name in os.listdir(directory) if name.endswith('.json') and not name.startswith('.'))
+
+@contextmanager
+def _submit_lock(queue_dir):
+    # Đếm pending/ rồi ghi job phải là một bước nguyên tử giữa các tiến trình submit,
+    # nếu không nhiều bên cùng thấy còn chỗ và vượt quá max_pending
+    lock_path = os.path.join(queue_dir, 'submit.lock')
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > SUBMIT_LOCK_STALE_SECONDS:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue  # khóa vừa được giải phóng
+            time.sleep(0.005)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def submit(image, mode=None, queue_dir=DEFAULT_QUEUE_DIR, max_pending=DEFAULT_MAX_PENDING, timeout=None):
+    # image: đường dẫn file hoặc bytes của ảnh
+    dirs = _ensure_dirs(queue_dir)
+    job_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image_path = os.path.join(dirs['inputs'], job_id)
+        with open(image_path, 'wb') as f:
+            f.write(image)
+        owned_input = True
+    else:
+        image_path = os.path.abspath(image)
+        owned_input = False
+
+    with _submit_lock(queue_dir):
+        queue_full = len(_job_files(dirs['pending'])) >= max_pending
+        if not queue_full:
+            atomic_write_json(os.path.join(dirs['pending'], f"{job_id}.json"), {
+                'id': job_id,
+                'image': image_path,
+                'owned_input': owned_input,
+                'mode': mode,
+                'timeout': timeout,
+                'submitted_at': time.time()
+            })
+    if queue_full:
+        if owned_input:
+            os.remove(image_path)
+        return {'success': False, 'queue_full': True, 'message': 'Hệ thống đang bận, vui lòng thử lại sau'}
+    return {'success': True, 'job_id': job_id, 'status': 'pending'}
+
+def status(job_id, queue_dir=DEFAULT_QUEUE_DIR):
+    dirs = _dirs(queue_dir)
+    done_path = os.path.join(dirs['done'], f"{job_id}.json")
+    if os.path.exists(done_path):
+        return _read_json(done_path)
+    for state in ('running', 'pending'):
+        if os.path.exists(os.path.join(dirs[state], f"{job_id}.json")):
+            return {'success': True, 'job_id': job_id, 'status': state}
+    return {'success': False, 'job_id': job_id, 'status': 'unknown', 'message': 'Không tìm thấy công việc'}
+
+def wait(job_id, timeout=None, queue_dir=DEFAULT_QUEUE_DIR):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        current = status(job_id, queue_dir)
+        if current['status'] not in ('pending', 'running'):
+            return current
+        if deadline is not None and time.monotonic() >= deadline:
+            return current
+        time.sleep(POLL_INTERVAL)
+
+def _worker_main(conn):
+    # Tiến trình con: nạp thư viện nặng một lần rồi nhận từng job qua pipe. Bỏ qua Ctrl-C
+    # (gửi tới cả nhóm tiến trình) để job đang chạy hoàn tất, tiến trình cha sẽ yêu cầu dừng
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import analyze_image
+    import image_engine  # noqa: F401 - nạp sẵn các thư viện nặng
+    conn.send('ready')
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        image_path, mode = job
+        try:
+            result = analyze_image.analyze(image_path, mode=mode or analyze_image.DEFAULT_COLOR_MODE)
+        except Exception as e:
+            result = {'success': False, 'message': str(e)}
+        conn.send(result)
+
+class _WarmWorker:
+    def __init__(self, context):
+        self._context = context
+        self._process = None
+        self._conn = None
+
+    def start(self):
+        parent_conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        try:
+            self._conn.recv()
+        except EOFError:
+            self.stop(kill=True)
+            raise RuntimeError("Không thể khởi động tiến trình phân tích")
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def run(self, image_path, mode, timeout):
+        if not self.alive:
+            self.stop(kill=True)
+            self.start()
+        self._conn.send((image_path, mode))
+        if not self._conn.poll(timeout):
+            # Không thể hủy giữa chừng một job đang chạy nên kill tiến trình; slot sẽ khởi động lại sau khi ghi kết quả
+            self.stop(kill=True)
+            raise TimeoutError(f"Quá thời gian phân tích ({timeout:g} giây)")
+        return self._conn.recv()
+
+    def stop(self, kill=False):
+        if self._process is None:
+            return
+        if kill:
+            self._process.kill()
+        else:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        self._process.join(5)
+        self._conn.close()
+        self._process = None
+
+class JobWorker:
+    def __init__(self, queue_dir=DEFAULT_QUEUE_DIR, concurrency=None, timeout=DEFAULT_TIMEOUT):
+        self.queue_dir = queue_dir
+        self.dirs = _ensure_dirs(queue_dir)
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._claim_lock = threading.Lock()
+        self._context = multiprocessing.get_context('spawn')
+
+    def recover(self):
+        # Job còn trong running/ từ lần chạy trước (worker bị tắt đột ngột) được xếp lại hàng đợi.
+        # Mỗi thư mục hàng đợi chỉ nên có một tiến trình worker, tăng --concurrency để xử lý song song
+        for name in _job_files(self.dirs['running']):
+            self._requeue(os.path.join(self.dirs['running'], name))
+
+    def _claim(self):
+        with self._claim_lock:
+            for name in _job_files(self.dirs['pending']):
+                running_path = os.path.join(self.dirs['running'], name)
+                try:
+                    os.replace(os.path.join(self.dirs['pending'], name), running_path)
+                except FileNotFoundError:
+                    continue  # worker khác đã nhận job này
+                return running_path
+        return None
+
+    def _finish(self, running_path, job, result, job_status, started):
+        atomic_write_json(os.path.join(self.dirs['done'], os.path.basename(running_path)), {
+            'success': result.get('success', False),
+            'job_id': job['id'],
+            'status': job_status,
+            'result': result,
+            'queue_ms': round((started - job['submitted_at']) * 1000, 3),
+            'run_ms': round((time.time() - started) * 1000, 3)
+        })
+        os.remove(running_path)
+        if job.get('owned_input'):
+            try:
+                os.remove(job['image'])
+            except OSError:
+                pass
+
+    def _requeue(self, running_path):
+        os.replace(running_path, os.path.join(self.dirs['pending'], os.path.basename(running_path)))
+
+    def _restart(self, worker):
+        try:
+            worker.start()
+        except RuntimeError:
+            pass  # thử lại khi nhận job tiếp theo, job đó sẽ báo lỗi nếu vẫn không khởi động được
+
+    def _run_slot(self, worker):
+        self._restart(worker)
+        try:
+            while not self._stop.is_set():
+                running_path = self._claim()
+                if running_path is None:
+                    self._stop.wait(POLL_INTERVAL)
+                    continue
+                job = _read_json(running_path)
+                started = time.time()
+                try:
+                    result = worker.run(job['image'], job.get('mode'), job.get('timeout') or self.timeout)
+                    job_status = 'done' if result.get('success') else 'failed'
+                except TimeoutError as e:
+                    result, job_status = {'success': False, 'message': str(e)}, 'timeout'
+                except Exception as e:
+                    if self._stop.is_set():
+                        # Tiến trình con bị dừng cùng worker: job chưa chạy xong nên trả lại hàng đợi
+                        self._requeue(running_path)
+                        break
+                    result, job_status = {'success': False, 'message': str(e)}, 'failed'
+                self._finish(running_path, job, result, job_status, started)
+                if not worker.alive:
+                    self._restart(worker)
+        finally:
+            worker.stop()
+
+    def cleanup(self, retention=RESULT_RETENTION_SECONDS):
+        # Xóa kết quả đã quá thời hạn lưu mà bên gọi chưa lấy
+        cutoff = time.time() - retention
+        for name in _job_files(self.dirs['done']):
+            path = os.path.join(self.dirs['done'], name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def run(self):
+        self.recover()
+        threads = [threading.Thread(target=self._run_slot, args=(_WarmWorker(self._context),), daemon=True)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        print(json.dumps({'success': True, 'message': f'Đang xử lý hàng đợi tại {os.path.abspath(self.queue_dir)}',
+                          'concurrency': self.concurrency}, ensure_ascii=False), flush=True)
+        try:
+            while not self._stop.is_set():
+                self.cleanup()
+                self._stop.wait(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Hàng đợi công việc phân tích ảnh hoa')
+    parser.add_argument('--queue-dir', default=DEFAULT_QUEUE_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    worker_parser = subparsers.add_parser('worker', help='Chạy worker xử lý hàng đợi')
+    worker_parser.add_argument('--concurrency', type=int, default=None, help='Số ảnh phân tích đồng thời (mặc định: số nhân CPU)')
+    worker_parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Thời gian tối đa cho mỗi job (giây)')
+
+    submit_parser = subparsers.add_parser('submit', help='Gửi một ảnh vào hàng đợi')
+    submit_parser.add_argument('image', help='Đường dẫn ảnh, hoặc "-" để đọc từ stdin')
+    submit_parser.add_argument('--mode', default=None)
+    submit_parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING)
+    submit_parser.add_argument('--timeout', type=float, default=None, help='Thời gian tối đa cho job này (giây)')
+    submit_parser.add_argument('--wait', type=float, default=None, help='Chờ kết quả tối đa số giây này')
+
+    status_parser = subparsers.add_parser('status', help='Xem trạng thái hoặc kết quả của job')
+    status_parser.add_argument('job_id')
+
+    wait_parser = subparsers.add_parser('wait', help='Chờ job hoàn thành')
+    wait_parser.add_argument('job_id')
+    wait_parser.add_argument('--timeout', type=float, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'worker':
+        JobWorker(args.queue_dir, args.concurrency, args.timeout).run()
+        return
+
+    try:
+        if args.command == 'submit':
+            image = sys.stdin.buffer.read() if args.image == '-' else args.image
+            result = submit(image, args.mode, args.queue_dir, args.max_pending, args.timeout)
+            if result['success'] and args.wait is not None:
+                result = wait(result['job_id'], args.wait, args.queue_dir)
+        elif args.command == 'status':
+            result = status(args.job_id, args.queue_dir)
+        else:
+            result = wait(args.job_id, args.timeout, args.queue_dir)
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
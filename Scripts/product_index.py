@@ -0,0 +1,188 @@
+﻿import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+import flower_model
+from analysis_common import COLORS, MODEL_PATH, PRESENTATIONS, ROOT_DIR, atomic_write, atomic_write_json, read_manifest
+
+sys.stdout.reconfigure(encoding='utf-8')
+
+# Chỉ mục ảnh sản phẩm để tìm kiếm theo độ tương đồng hình ảnh: mỗi ảnh được nhúng
+# một lần bằng FlowerModel (đặc trưng 256 chiều trước các lớp đầu, hoặc 2048 chiều của
+# ResNet-50), chuẩn hóa L2 và lưu thành ma trận float16. Truy vấn top-k là một phép
+# nhân ma trận trên toàn bộ chỉ mục (tìm chính xác, đủ nhanh với vài chục nghìn ảnh).
+# Lệnh query nạp lại mô hình mỗi lần gọi; dịch vụ cần trả lời nhanh nên dùng POST /similar
+# của inference_server.py, nơi mô hình và chỉ mục được giữ sẵn trong bộ nhớ.
+INDEX_DIR = os.path.join(os.path.dirname(__file__), "..", "Models", "product_index")
+FEATURES = {'penultimate': 256, 'backbone': 2048}
+
+_embedding_model = None
+
+def load_embedding_model():
+    # Cần truy cập các lớp bên trong nên luôn dùng mô hình fp32 thay vì artifact TorchScript;
+    # nếu tiến trình đã nạp sẵn mô hình fp32 (ví dụ inference_server không dùng artifact) thì dùng lại
+    global _embedding_model
+    if _embedding_model is None and not flower_model.use_artifact():
+        _embedding_model = flower_model.load_model()
+    if _embedding_model is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        model = flower_model.FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS))
+        model.load_state_dict(torch.load(MODEL_PATH, map_location=device))
+        model.to(device).eval()
+        _embedding_model = (model, device)
+    return _embedding_model
+
+def model_version():
+    stat = os.stat(MODEL_PATH)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def embed(images, feature='penultimate', batch_size=32):
+    # images: danh sách đường dẫn hoặc bytes; trả về ma trận float32 đã chuẩn hóa L2
+    tensors = [flower_model.load_image(image) for image in images]
+    return embed_tensors(tensors, feature, batch_size)
+
+def embed_tensors(tensors, feature='penultimate', batch_size=32):
+    model, device = load_embedding_model()
+    outputs = []
+    with torch.no_grad():
+        for i in range(0, len(tensors), batch_size):
+            x = model.resnet(torch.stack(tensors[i:i + batch_size]).to(device))
+            if feature == 'penultimate':
+                x = model.fc(x)
+            outputs.append(torch.nn.functional.normalize(x, dim=1).cpu())
+    if not outputs:
+        return np.zeros((0, FEATURES[feature]), dtype=np.float32)
+    return torch.cat(outputs).numpy()
+
+class ProductIndex:
+    def __init__(self, index_dir=INDEX_DIR, feature='penultimate'):
+        self.index_dir = index_dir
+        self.feature = feature
+        self.model_version = None
+        self.entries = []
+        self.embeddings = np.zeros((0, FEATURES[feature]), dtype=np.float16)
+
+    @classmethod
+    def load(cls, index_dir=INDEX_DIR):
+        with open(os.path.join(index_dir, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        index = cls(index_dir, meta['feature'])
+        index.model_version = meta['model_version']
+        index.entries = meta['entries']
+        index.embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'))
+        return index
+
+    @classmethod
+    def load_or_create(cls, index_dir=INDEX_DIR, feature='penultimate'):
+        if os.path.exists(os.path.join(index_dir, 'meta.json')):
+            return cls.load(index_dir)
+        return cls(index_dir, feature)
+
+    def save(self):
+        # meta.json được thay sau cùng: inference_server nạp lại chỉ mục khi meta.json thay đổi
+        with atomic_write(os.path.join(self.index_dir, 'embeddings.npy'), 'wb') as f:
+            np.save(f, self.embeddings)
+        atomic_write_json(os.path.join(self.index_dir, 'meta.json'),
+                          {'feature': self.feature, 'model_version': self.model_version, 'entries': self.entries})
+
+    def add(self, product_ids, image_paths, root_dir=ROOT_DIR):
+        # Thêm ảnh mới; ảnh đã có của cùng sản phẩm sẽ được nhúng lại
+        if self.entries and self.model_version != model_version():
+            raise ValueError("Chỉ mục được tạo bằng phiên bản mô hình khác, vui lòng chạy lại lệnh build")
+        # Ảnh thiếu hoặc không giải mã được bị bỏ qua và trả về để báo cáo, không làm hỏng cả lần build
+        tensors, added, failed, seen = [], [], [], set()
+        for pid, path in zip(product_ids, image_paths):
+            if (int(pid), path) in seen:
+                continue  # dòng lặp lại trong manifest
+            seen.add((int(pid), path))
+            try:
+                tensors.append(flower_model.load_image(os.path.join(root_dir, path.lstrip('/\\'))))
+                added.append((int(pid), path))
+            except Exception as e:
+                failed.append({'product_id': int(pid), 'image': path, 'message': str(e)})
+        vectors = embed_tensors(tensors, self.feature).astype(np.float16)
+        keys = set(added)
+        keep = [i for i, e in enumerate(self.entries) if (e['product_id'], e['image']) not in keys]
+        self.entries = [self.entries[i] for i in keep] + [{'product_id': pid, 'image': path} for pid, path in added]
+        self.embeddings = np.concatenate([self.embeddings[keep], vectors])
+        self.model_version = model_version()
+        return failed
+
+    def remove(self, product_id):
+        keep = [i for i, e in enumerate(self.entries) if e['product_id'] != int(product_id)]
+        self.entries = [self.entries[i] for i in keep]
+        self.embeddings = self.embeddings[keep]
+
+    def query(self, image, k=10):
+        if not self.entries:
+            return []
+        vector = embed([image], self.feature)[0]
+        scores = self.embeddings.astype(np.float32) @ vector
+
+        # Một sản phẩm có thể có nhiều ảnh: lấy điểm cao nhất của mỗi sản phẩm
+        best = {}
+        for i in np.argsort(-scores):
+            product_id = self.entries[i]['product_id']
+            if product_id not in best:
+                best[product_id] = (float(scores[i]), self.entries[i]['image'])
+                if len(best) >= k:
+                    break
+        return [{'product_id': pid, 'score': score, 'image': image_path}
+                for pid, (score, image_path) in best.items()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Chỉ mục ảnh sản phẩm cho tìm kiếm theo độ tương đồng')
+    parser.add_argument('--index-dir', default=INDEX_DIR)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Tạo lại chỉ mục từ file CSV product_id,image_path')
+    build_parser.add_argument('manifest')
+    build_parser.add_argument('--feature', choices=list(FEATURES), default='penultimate')
+
+    add_parser = subparsers.add_parser('add', help='Thêm ảnh của một sản phẩm vào chỉ mục')
+    add_parser.add_argument('--product-id', type=int, required=True)
+    add_parser.add_argument('--image', action='append', required=True)
+
+    remove_parser = subparsers.add_parser('remove', help='Xóa một sản phẩm khỏi chỉ mục')
+    remove_parser.add_argument('--product-id', type=int, required=True)
+
+    query_parser = subparsers.add_parser('query', help='Tìm các sản phẩm giống ảnh tải lên nhất')
+    query_parser.add_argument('image', help='Đường dẫn ảnh, hoặc "-" để đọc từ stdin')
+    query_parser.add_argument('--k', type=int, default=10)
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'build':
+            index = ProductIndex(args.index_dir, args.feature)
+            rows = read_manifest(args.manifest)
+            failed = index.add([pid for pid, _ in rows], [image for _, image in rows])
+            index.save()
+            result = {'success': True, 'entries': len(index.entries), 'failed': failed}
+        elif args.command == 'add':
+            index = ProductIndex.load_or_create(args.index_dir)
+            failed = index.add([args.product_id] * len(args.image), args.image)
+            index.save()
+            result = {'success': not failed, 'entries': len(index.entries), 'failed': failed}
+        elif args.command == 'remove':
+            index = ProductIndex.load(args.index_dir)
+            index.remove(args.product_id)
+            index.save()
+            result = {'success': True, 'entries': len(index.entries)}
+        else:
+            index = ProductIndex.load(args.index_dir)
+            image = sys.stdin.buffer.read() if args.image == '-' else args.image
+            result = {
+                'success': True,
+                'stale': index.model_version != model_version(),
+                'results': index.query(image, args.k)
+            }
+    except Exception as e:
+        result = {'success': False, 'message': str(e)}
+    print(json.dumps(result, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
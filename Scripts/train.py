@@ -1,13 +1,18 @@
 ﻿import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, TensorDataset
 from torchvision import models, transforms
 from PIL import Image
 import pandas as pd
 import numpy as np
+import argparse
+import hashlib
 import os
 import sys
+import time
+from analysis_common import ROOT_DIR, atomic_write
+from dataset_store import CachedFlowerDataset, ensure_store, images_fingerprint
 
 # Định nghĩa danh sách màu và kiểu trình bày
 COLORS = ['đỏ', 'đỏ đậm', 'đỏ tươi', 'đỏ cherry', 'đỏ rượu', 'đỏ hồng', 'hồng', 'hồng nhạt', 'hồng đậm', 'hồng phấn',
@@ -71,8 +76,11 @@ class FlowerModel(nn.Module):
         self.pres_head = nn.Linear(256, num_presentations)
 
     def forward(self, x):
-        x = self.resnet(x)
-        x = self.fc(x)
+        return self.forward_heads(self.resnet(x))
+
+    def forward_heads(self, features):
+        # Phần đầu phân loại, nhận đặc trưng 2048 chiều từ backbone ResNet-50
+        x = self.fc(features)
         color_out = torch.sigmoid(self.color_head(x))
         pres_out = self.pres_head(x)
         return color_out, pres_out
@@ -92,51 +100,294 @@ val_transform = transforms.Compose([
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 ])
 
-# Load dữ liệu
-root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "wwwroot"))
-train_dataset = FlowerDataset(csv_file='data/train.csv', root_dir=root_dir, transform=train_transform)
-val_dataset = FlowerDataset(csv_file='data/val.csv', root_dir=root_dir, transform=val_transform)
-
-train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-val_loader = DataLoader(val_dataset, batch_size=32, shuffle=False)
-
-# Khởi tạo mô hình
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS)).to(device)
-color_criterion = nn.BCELoss()
-pres_criterion = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=0.001)
-
-# Huấn luyện
-num_epochs = 50
-best_val_loss = float('inf')
-for epoch in range(num_epochs):
-    model.train()
-    train_loss = 0
-    for images, color_labels, pres_labels in train_loader:
-        images, color_labels, pres_labels = images.to(device), color_labels.to(device), pres_labels.to(device)
+# Biến đổi cho ảnh lấy từ kho đã tiền xử lý (tensor uint8 đã resize sẵn)
+stored_train_transform = transforms.Compose([
+    transforms.RandomHorizontalFlip(),
+    transforms.RandomRotation(10),
+    transforms.ConvertImageDtype(torch.float),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+stored_val_transform = transforms.Compose([
+    transforms.ConvertImageDtype(torch.float),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "..", "Models", "best_model.pth")
+CHECKPOINT_PATH = os.path.join(os.path.dirname(__file__), "..", "Models", "checkpoints", "last_checkpoint.pth")
+FEATURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'features')
+
+def load_datasets(use_store=True, rebuild_store=False):
+    if not use_store:
+        train_dataset = FlowerDataset(csv_file='data/train.csv', root_dir=ROOT_DIR, transform=train_transform)
+        val_dataset = FlowerDataset(csv_file='data/val.csv', root_dir=ROOT_DIR, transform=val_transform)
+        return train_dataset, val_dataset
+
+    # Giải mã và resize ảnh một lần, các lần chạy sau dùng lại nếu CSV không đổi
+    train_store = ensure_store('data/train.csv', ROOT_DIR, COLORS, PRESENTATIONS, rebuild=rebuild_store)
+    val_store = ensure_store('data/val.csv', ROOT_DIR, COLORS, PRESENTATIONS, rebuild=rebuild_store)
+    return (CachedFlowerDataset(train_store, transform=stored_train_transform),
+            CachedFlowerDataset(val_store, transform=stored_val_transform))
+
+def make_loader(dataset, batch_size, shuffle, num_workers):
+    options = {}
+    if num_workers > 0:
+        options = {'prefetch_factor': 4, 'persistent_workers': True}
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      pin_memory=torch.cuda.is_available(), **options)
+
+def configure_threads(num_threads=None):
+    # Đặt số luồng tính toán của PyTorch theo số nhân CPU (hoặc theo tham số)
+    num_threads = num_threads or os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(max(1, min(4, num_threads // 2)))
+    except RuntimeError:
+        # Chỉ đặt được trước khi PyTorch bắt đầu chạy song song
+        pass
+    return num_threads
+
+def cpu_supports_bf16():
+    # CPU không có lệnh bf16 (AVX512-BF16/AMX) chỉ giả lập bf16 nên chậm hơn fp32
+    try:
+        return torch._C._cpu._is_avx512_bf16_supported() or torch._C._cpu._is_amx_tile_supported()
+    except AttributeError:
+        return False
+
+def autocast_dtype(device, precision):
+    # auto: chỉ dùng bf16 khi phần cứng hỗ trợ trực tiếp; bf16: luôn bật trên CPU
+    if precision == 'fp32':
+        return None
+    if device.type == 'cpu':
+        return torch.bfloat16 if precision == 'bf16' or cpu_supports_bf16() else None
+    if torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return None
+
+def save_checkpoint(path, model, optimizer, epoch, best_val_loss, epochs_without_improvement):
+    with atomic_write(path, 'wb') as f:
+        torch.save({
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'epoch': epoch,
+            'best_val_loss': best_val_loss,
+            'epochs_without_improvement': epochs_without_improvement
+        }, f)
+
+def train(num_epochs=50, batch_size=32, num_workers=None, use_store=True, rebuild_store=False,
+          precision='auto', accumulation_steps=1, patience=10, checkpoint_path=CHECKPOINT_PATH, resume=False):
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+
+    # Load dữ liệu
+    train_dataset, val_dataset = load_datasets(use_store, rebuild_store)
+    train_loader = make_loader(train_dataset, batch_size, True, num_workers)
+    val_loader = make_loader(val_dataset, batch_size, False, num_workers)
+
+    # Khởi tạo mô hình
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS)).to(device)
+    color_criterion = nn.BCELoss()
+    pres_criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    amp_dtype = autocast_dtype(device, precision)
+
+    start_epoch = 0
+    best_val_loss = float('inf')
+    epochs_without_improvement = 0
+    if resume and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        start_epoch = checkpoint['epoch'] + 1
+        best_val_loss = checkpoint['best_val_loss']
+        epochs_without_improvement = checkpoint['epochs_without_improvement']
+        print(f'Tiếp tục huấn luyện từ epoch {start_epoch + 1}')
+
+    def compute_loss(images, color_labels, pres_labels):
+        with torch.autocast(device_type=device.type, dtype=amp_dtype or torch.bfloat16, enabled=amp_dtype is not None):
+            color_out, pres_out = model(images)
+        # Hàm mất mát tính ở fp32 để ổn định số học
+        return color_criterion(color_out.float(), color_labels) + pres_criterion(pres_out.float(), pres_labels)
+
+    # Huấn luyện
+    for epoch in range(start_epoch, num_epochs):
+        model.train()
+        # Cộng dồn loss trên thiết bị, chỉ đồng bộ một lần mỗi epoch thay vì gọi .item() mỗi batch
+        train_loss = torch.zeros((), device=device)
+        started = time.perf_counter()
         optimizer.zero_grad()
-        color_out, pres_out = model(images)
-        color_loss = color_criterion(color_out, color_labels)
-        pres_loss = pres_criterion(pres_out, pres_labels)
-        loss = color_loss + pres_loss
-        loss.backward()
-        optimizer.step()
-        train_loss += loss.item()
-    
-    model.eval()
-    val_loss = 0
+        for step, (images, color_labels, pres_labels) in enumerate(train_loader, 1):
+            images = images.to(device, non_blocking=True)
+            color_labels = color_labels.to(device, non_blocking=True)
+            pres_labels = pres_labels.to(device, non_blocking=True)
+            loss = compute_loss(images, color_labels, pres_labels)
+            # Nhóm cuối có thể ít batch hơn accumulation_steps: chia theo số batch thực có trong nhóm
+            group_start = (step - 1) // accumulation_steps * accumulation_steps
+            (loss / min(accumulation_steps, len(train_loader) - group_start)).backward()
+            if step % accumulation_steps == 0 or step == len(train_loader):
+                optimizer.step()
+                optimizer.zero_grad()
+            train_loss += loss.detach()
+        train_time = time.perf_counter() - started
+        
+        model.eval()
+        val_loss = torch.zeros((), device=device)
+        with torch.no_grad():
+            for images, color_labels, pres_labels in val_loader:
+                images, color_labels, pres_labels = images.to(device), color_labels.to(device), pres_labels.to(device)
+                val_loss += compute_loss(images, color_labels, pres_labels)
+        train_loss = train_loss.item()
+        val_loss = val_loss.item()
+        
+        throughput = len(train_dataset) / train_time if train_time > 0 else 0.0
+        print(f'Epoch {epoch+1}/{num_epochs}, Train Loss: {train_loss/len(train_loader):.4f}, Val Loss: {val_loss/len(val_loader):.4f}, '
+              f'Throughput: {throughput:.1f} images/sec')
+        
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            epochs_without_improvement = 0
+            torch.save(model.state_dict(), MODEL_PATH)
+        else:
+            epochs_without_improvement += 1
+
+        save_checkpoint(checkpoint_path, model, optimizer, epoch, best_val_loss, epochs_without_improvement)
+
+        if patience and epochs_without_improvement >= patience:
+            print(f'Dừng sớm: Val Loss không cải thiện sau {patience} epoch')
+            break
+
+def backbone_fingerprint(model):
+    h = hashlib.sha1()
+    for tensor in model.resnet.state_dict().values():
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+def extract_features(model, dataset, device, batch_size, num_workers):
+    loader = make_loader(dataset, batch_size, False, num_workers)
+    features = []
+    model.resnet.eval()
     with torch.no_grad():
-        for images, color_labels, pres_labels in val_loader:
-            images, color_labels, pres_labels = images.to(device), color_labels.to(device), pres_labels.to(device)
-            color_out, pres_out = model(images)
-            color_loss = color_criterion(color_out, color_labels)
-            pres_loss = pres_criterion(pres_out, pres_labels)
-            loss = color_loss + pres_loss
-            val_loss += loss.item()
-    
-    print(f'Epoch {epoch+1}/{num_epochs}, Train Loss: {train_loss/len(train_loader):.4f}, Val Loss: {val_loss/len(val_loader):.4f}')
-    
-    if val_loss < best_val_loss:
-        best_val_loss = val_loss
-        torch.save(model.state_dict(), os.path.join(os.path.dirname(__file__), "..", "Models", "best_model.pth"))
\ No newline at end of file
+        for images, _, _ in loader:
+            features.append(model.resnet(images.to(device)).cpu())
+    return torch.cat(features)
+
+def cached_features(model, fingerprint, csv_file, dataset, device, batch_size, num_workers, augment_variants=0):
+    # Đặc trưng chỉ phụ thuộc vào ảnh và trọng số backbone, không phụ thuộc nhãn,
+    # nên sửa nhãn trong CSV không làm mất cache. Khóa gồm cả dấu vân tay ảnh của kho dữ liệu
+    # để ảnh bị thay bằng file khác cùng tên không dùng lại đặc trưng cũ
+    image_paths = pd.read_csv(os.path.join(ROOT_DIR, csv_file)).iloc[:, 0].tolist()
+    parts = [fingerprint, str(augment_variants), images_fingerprint(dataset.store_dir)]
+    key = hashlib.sha1('\n'.join(parts + image_paths).encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    path = os.path.join(FEATURE_DIR, f'{name}-{key}.pt')
+    if os.path.exists(path):
+        return torch.load(path)
+
+    # Lượt đầu dùng ảnh gốc, các lượt sau dùng biến đổi ngẫu nhiên để tăng cường dữ liệu
+    variants = []
+    for variant in range(augment_variants + 1):
+        dataset.transform = stored_val_transform if variant == 0 else stored_train_transform
+        variants.append(extract_features(model, dataset, device, batch_size, num_workers))
+    features = torch.stack(variants)
+
+    os.makedirs(FEATURE_DIR, exist_ok=True)
+    torch.save(features, path)
+    return features
+
+def train_heads(num_epochs=30, batch_size=64, num_workers=None, augment_variants=0, init_from=MODEL_PATH,
+                rebuild_store=False):
+    # Đóng băng backbone: tính đặc trưng 2048 chiều một lần, chỉ huấn luyện fc/color_head/pres_head
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = FlowerModel(num_colors=len(COLORS), num_presentations=len(PRESENTATIONS))
+    if init_from and os.path.exists(init_from):
+        model.load_state_dict(torch.load(init_from, map_location='cpu'))
+    model = model.to(device)
+    for param in model.resnet.parameters():
+        param.requires_grad = False
+
+    train_dataset, val_dataset = load_datasets(use_store=True, rebuild_store=rebuild_store)
+    fingerprint = backbone_fingerprint(model)
+    train_features = cached_features(model, fingerprint, 'data/train.csv', train_dataset, device, batch_size,
+                                     num_workers, augment_variants)
+    val_features = cached_features(model, fingerprint, 'data/val.csv', val_dataset, device, batch_size,
+                                   num_workers)[0]
+
+    # Mỗi biến thể tăng cường dùng lại nhãn của ảnh gốc
+    num_variants = train_features.shape[0]
+    train_set = TensorDataset(train_features.reshape(-1, train_features.shape[-1]),
+                              train_dataset.color_labels.repeat(num_variants, 1),
+                              train_dataset.pres_labels.repeat(num_variants))
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
+    val_loader = DataLoader(TensorDataset(val_features, val_dataset.color_labels, val_dataset.pres_labels),
+                            batch_size=batch_size, shuffle=False)
+
+    color_criterion = nn.BCELoss()
+    pres_criterion = nn.CrossEntropyLoss()
+    head_params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = optim.Adam(head_params, lr=0.001)
+
+    best_val_loss = float('inf')
+    for epoch in range(num_epochs):
+        model.train()
+        model.resnet.eval()
+        train_loss = 0
+        for features, color_labels, pres_labels in train_loader:
+            features, color_labels, pres_labels = features.to(device), color_labels.to(device), pres_labels.to(device)
+            optimizer.zero_grad()
+            color_out, pres_out = model.forward_heads(features)
+            loss = color_criterion(color_out, color_labels) + pres_criterion(pres_out, pres_labels)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()
+
+        model.eval()
+        val_loss = 0
+        with torch.no_grad():
+            for features, color_labels, pres_labels in val_loader:
+                features, color_labels, pres_labels = features.to(device), color_labels.to(device), pres_labels.to(device)
+                color_out, pres_out = model.forward_heads(features)
+                val_loss += (color_criterion(color_out, color_labels) + pres_criterion(pres_out, pres_labels)).item()
+
+        print(f'Epoch {epoch+1}/{num_epochs}, Train Loss: {train_loss/len(train_loader):.4f}, Val Loss: {val_loss/len(val_loader):.4f}')
+
+        # Lưu toàn bộ state_dict (backbone + heads) để inference.py dùng như bình thường
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            torch.save(model.state_dict(), MODEL_PATH)
+
+def main():
+    parser = argparse.ArgumentParser(description='Huấn luyện FlowerModel')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=None, help='Số worker của DataLoader (mặc định: tối đa 4)')
+    parser.add_argument('--no-store', action='store_true', help='Đọc trực tiếp ảnh gốc thay vì kho đã tiền xử lý')
+    parser.add_argument('--rebuild-store', action='store_true', help='Tạo lại kho dữ liệu đã tiền xử lý')
+    parser.add_argument('--prepare-only', action='store_true', help='Chỉ tạo kho dữ liệu đã tiền xử lý rồi dừng')
+    parser.add_argument('--mode', choices=['full', 'heads'], default='full',
+                        help='full: huấn luyện toàn bộ mô hình; heads: đóng băng backbone, chỉ huấn luyện các lớp đầu')
+    parser.add_argument('--augment-variants', type=int, default=0, help='Số biến thể tăng cường mỗi ảnh (chế độ heads)')
+    parser.add_argument('--init-from', default=MODEL_PATH, help='Trọng số khởi tạo cho chế độ heads (mặc định: best_model.pth nếu có)')
+    parser.add_argument('--threads', type=int, default=None, help='Số luồng tính toán của PyTorch (mặc định: số nhân CPU)')
+    parser.add_argument('--precision', choices=['auto', 'bf16', 'fp32'], default='auto',
+                        help='auto: bf16 khi GPU/CPU hỗ trợ trực tiếp, ngược lại fp32; bf16: luôn dùng autocast bfloat16')
+    parser.add_argument('--accumulation-steps', type=int, default=1, help='Số batch cộng dồn gradient trước mỗi bước tối ưu')
+    parser.add_argument('--patience', type=int, default=10, help='Dừng sớm sau số epoch không cải thiện (0 để tắt)')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH, help='File checkpoint đầy đủ (mô hình, optimizer, epoch)')
+    parser.add_argument('--resume', action='store_true', help='Tiếp tục từ checkpoint nếu có')
+    args = parser.parse_args()
+    configure_threads(args.threads)
+    if args.prepare_only:
+        load_datasets(use_store=True, rebuild_store=args.rebuild_store)
+        return
+    if args.mode == 'heads':
+        train_heads(args.epochs, args.batch_size, args.workers, args.augment_variants, args.init_from, args.rebuild_store)
+        return
+    train(args.epochs, args.batch_size, args.workers, not args.no_store, args.rebuild_store, args.precision,
+          max(1, args.accumulation_steps), args.patience, args.checkpoint, args.resume)
+
+if __name__ == '__main__':
+    main()